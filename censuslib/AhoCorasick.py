@@ -0,0 +1,65 @@
+from collections import deque
+
+class AhoCorasick:
+    """Multi-pattern automaton reporting every occurrence of a set of keys
+    in a single left-to-right pass over a string"""
+
+    def __init__(self, items=None):
+        """Builds the automaton from an iterable of (key, value) pairs"""
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [()]
+        if items:
+            for key, value in items:
+                self.add(key, value)
+        self.build()
+
+    def __len__(self):
+        return len(self.goto)
+
+    def add(self, key, value):
+        """Adds a key to the trie; build() must be called before matching"""
+        state = 0
+        for ch in key:
+            next_state = self.goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][ch] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append(())
+            state = next_state
+        self.outputs[state] = self.outputs[state] + (value,)
+
+    def build(self):
+        """Computes the failure links and merges the outputs along them"""
+        queue = deque(self.goto[0].values())
+        for state in queue:
+            self.fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and ch not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                fail_state = self.goto[fail_state].get(ch, 0)
+                self.fail[next_state] = fail_state
+                if self.outputs[fail_state]:
+                    self.outputs[next_state] = self.outputs[next_state] + self.outputs[fail_state]
+
+    def iter_matches(self, text, start=0):
+        """Yields (end_index, value) for every key occurring in text from start on"""
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        state = 0
+        for i, ch in enumerate(text[start:] if start else text, start):
+            next_state = goto[state].get(ch)
+            while next_state is None and state:
+                state = fail[state]
+                next_state = goto[state].get(ch)
+            state = next_state or 0
+            if outputs[state]:
+                for value in outputs[state]:
+                    yield i, value
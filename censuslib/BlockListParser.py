@@ -1,18 +1,59 @@
+import gc
+import hashlib
+import os
+import pickle
 import re
+import time
+from collections import Counter, defaultdict
+from AhoCorasick import AhoCorasick
+from CosmeticParser import CosmeticParser
 from FastHash import FastHash
+from HostCandidateCache import HostCandidateCache
+from PlainRuleParser import HostParser, LiteralParser, get_host_anchors
 from RegexParser import Parser
+from RequestContext import get_request_context
+from ResidueParser import ResidueParser
 
 class BlockListParser:
     """Creates maps of shortcut hashes with regex of the urls"""
 
-    def __init__(self, regex_file=None, regexes=None, shortcut_sizes=None, print_maps=False, support_hash=False):
-        """Initializes the shortcut to Parser map"""
+    # bump whenever the layout of the pickled maps changes
+    CACHE_VERSION = 12
+
+    def __init__(self, regex_file=None, regexes=None, shortcut_sizes=None, print_maps=False, support_hash=False,
+                 cache_dir=None, build_automaton=True, url_corpus=None, host_cache_size=None):
+        """Initializes the shortcut to Parser map
+
+        If cache_dir is given, the built maps are pickled there under a name derived from
+        the name of regex_file, the SHA-256 of the rules and the shortcut sizes, and loaded
+        back on later runs instead of being rebuilt. Saving them removes the pickles of
+        older versions of the list and of older CACHE_VERSIONs.
+
+        Element hiding rules are kept apart in a CosmeticParser, since they never match
+        a url. Network rules are split into tiers by how their url part can be tested: ||domain^ rules
+        are looked up by the url's host anchors in a dict, plain substring rules are
+        found by their shortcut and tested with a substring search, and only the other
+        rules are found by their shortcut and run as regexes.
+
+        build_automaton=False skips building the shortcut automaton, for maps that are
+        scanned by a CombinedBlockListParser; such a parser cannot check urls itself.
+
+        url_corpus is an optional sample of the urls to be checked. When given, each
+        rule gets the n-gram found in the fewest of those urls as its shortcut, instead
+        of the first unused one, so fewer urls hit shortcuts whose rules do not match.
+
+        With host_cache_size, check, should_block and should_block_many look the host
+        anchors of a url and the candidate rules which may match on its host up in a
+        HostCandidateCache of host_cache_size hosts, instead of working them out for
+        every url. It only pays off when urls share few hosts, so it is off by default.
+        """
         if regex_file is None:
             regex_lines = regexes
         else:
             with open(regex_file) as f:
                 regex_lines = f.readlines()
         self.regex_lines = regex_lines
+        self.host_cache = _make_host_cache(host_cache_size)
         self.fast_hashes = []
         self.print_maps = print_maps
         self.support_hash = support_hash
@@ -20,11 +61,33 @@ class BlockListParser:
             self.shortcut_sizes = shortcut_sizes
         else:
             self.shortcut_sizes = self._determine_shortcut_sizes(len(regex_lines))
+        if cache_dir is not None:
+            cache_path, list_prefix = self._get_cache_path(cache_dir, regex_file, regex_lines,
+                                                           build_automaton, url_corpus)
+            if self._load_cache(cache_path):
+                return
         for shortcut_size in self.shortcut_sizes:
             self.fast_hashes.append(FastHash(shortcut_size))
-        all_shortcut_url_maps, remaining_lines = self._get_all_shortcut_url_maps(regex_lines)
-        self.all_shortcut_parser_maps = self._get_all_shortcut_parser_maps(all_shortcut_url_maps)
-        self.remaining_regex = self._convert_to_regex(remaining_lines)
+        cosmetic_lines, network_lines = self._split_cosmetic_rules(regex_lines)
+        self.cosmetic_parser = CosmeticParser(cosmetic_lines)
+        host_rule_map, shortcut_lines = self._split_host_rules(network_lines)
+        self.host_parsers = self._get_host_parsers(host_rule_map)
+        if url_corpus is None:
+            self.shortcut_frequencies = None
+        else:
+            self.shortcut_frequencies = self._count_shortcut_frequencies(shortcut_lines, url_corpus)
+        all_shortcut_url_maps, remaining_lines = self._get_all_shortcut_url_maps(shortcut_lines)
+        self.all_shortcut_parser_maps, self.all_shortcut_literal_maps = \
+            self._get_all_shortcut_parser_maps(all_shortcut_url_maps)
+        self.remaining_regex = ResidueParser(remaining_lines)
+        if self.support_hash:
+            self.all_shortcut_hash_maps = self._get_all_shortcut_hash_maps()
+        elif build_automaton:
+            self.shortcut_automaton = self._build_shortcut_automaton()
+        else:
+            self.shortcut_automaton = None
+        if cache_dir is not None:
+            self._save_cache(cache_path, list_prefix)
 
     def get_num_classes(self):
         # always supports only binary classification, blocked or not blocked
@@ -35,99 +98,138 @@ class BlockListParser:
 
     def should_block(self, url, options=None):
         """Check if url is in the patterns"""
-        if self.support_hash:
-            return self._should_block_with_hash()
+        return self.check(url, options) == -1
+
+    def check(self, url, options=None):
+        """Returns 1 if url is whitelisted, -1 if it is blacklisted and not whitelisted, 0 otherwise"""
+        options = get_request_context(options)
+        return self._check_candidates(url, options, options.signature, self._cached_candidate_parsers(url))
+
+    def check_with_domain_sensitivity(self, url, options=None):
+        """Returns check's verdict, and whether a $domain rule applies to url with these
+        options, that is whether the verdict may change with the first-party domain"""
+        options = get_request_context(options)
+        signature = options.signature
+        parsers = list(self._cached_candidate_parsers(url))
+        return (self._check_candidates(url, options, signature, parsers),
+                self._is_domain_sensitive(options, signature, parsers))
+
+    def should_block_many(self, urls, options_list=None):
+        """Check a batch of urls, options_list holding the options of each url
+
+        Identical (url, options) pairs are only classified once, and each candidate
+        Parser is run over all the urls that hit its shortcut together.
+        """
+        unique_urls, unique_options, unique_signatures, positions = _deduplicate(urls, options_list)
+        candidates = [self._cached_candidate_parsers(url) for url in unique_urls]
+        states = self._check_many(unique_urls, unique_options, unique_signatures, candidates)
+        return [states[i] == -1 for i in positions]
+
+    def _check_candidates(self, url, options, signature, parsers):
+        """Checks url against the given candidate Parsers and remaining_regex"""
         blacklisted = False
-        for k in range(len(self.shortcut_sizes)):
-            shortcut_size = self.shortcut_sizes[k]
-            regex_map = self.all_shortcut_parser_maps[k]
-            for i in range(len(url) - shortcut_size + 1):
-                cur_sub = url[i:i+shortcut_size]
-                if cur_sub in regex_map:
-                    parser = regex_map[cur_sub]
-                    if blacklisted:
-                        if parser.is_whitelisted(url, options):
-                            return False
-                    else:
-                        state = parser.check(url, options)
-                        if state == 1:
-                            return False
-                        elif state == -1:
-                            blacklisted = True
+        for parser in parsers:
+            if blacklisted:
+                if parser.is_whitelisted(url, options, signature):
+                    return 1
+            else:
+                state = parser.check(url, options, signature)
+                if state == 1:
+                    return 1
+                elif state == -1:
+                    blacklisted = True
         if blacklisted:
-            if self.remaining_regex.is_whitelisted(url, options):
-                return False
+            if self.remaining_regex.is_whitelisted(url, options, signature):
+                return 1
         else:
-            state = self.remaining_regex.check(url, options)
+            state = self.remaining_regex.check(url, options, signature)
             if state == 1:
-                return False
+                return 1
             elif state == -1:
                 blacklisted = True
-        return blacklisted
+        return -1 if blacklisted else 0
+
+    def _is_domain_sensitive(self, options, signature, parsers):
+        if self.remaining_regex.is_domain_sensitive(options, signature):
+            return True
+        return any(parser.is_domain_sensitive(options, signature) for parser in parsers)
+
+    def _check_many(self, urls, options_list, signatures, candidates):
+        """Like _check_candidates for a batch of distinct urls, candidates holding the
+        candidate Parsers of each url; every Parser is run over all of its urls together"""
+        urls_by_parser = defaultdict(list)
+        for i, parsers in enumerate(candidates):
+            for parser in parsers:
+                indices = urls_by_parser[parser]
+                if not indices or indices[-1] != i:
+                    indices.append(i)
+        urls_by_parser[self.remaining_regex] = list(range(len(urls)))
+
+        # a url is blocked if any candidate blacklists it and none whitelists it
+        whitelisted = [False] * len(urls)
+        blacklisted = [False] * len(urls)
+        for parser, indices in urls_by_parser.items():
+            indices = [i for i in indices if not whitelisted[i]]
+            if not indices:
+                continue
+            matches = parser.whitelisted_many([urls[i] for i in indices],
+                                              [options_list[i] for i in indices],
+                                              [signatures[i] for i in indices])
+            for i, match in zip(indices, matches):
+                whitelisted[i] = match
+            indices = [i for i in indices if not whitelisted[i] and not blacklisted[i]]
+            if not indices:
+                continue
+            matches = parser.blacklisted_many([urls[i] for i in indices],
+                                              [options_list[i] for i in indices],
+                                              [signatures[i] for i in indices])
+            for i, match in zip(indices, matches):
+                blacklisted[i] = match
+        return [1 if white else -1 if black else 0 for white, black in zip(whitelisted, blacklisted)]
+
+    def trace(self, url, options=None):
+        """Returns a record of how url is classified, checking every candidate in full:
+
+        - 'verdict': 1 if whitelisted, -1 if blacklisted and not whitelisted, 0 otherwise,
+          as returned by check, and 'blocked'
+        - 'whitelisted_by' and 'blacklisted_by': the rules matching url
+        - 'hits': one dict per candidate, with its 'tier' ('host', 'regex', 'literal' or
+          'residue'), its 'key' (domain or shortcut), shortcut 'size', number of 'rules',
+          the rules of it which 'whitelisted_by' and 'blacklisted_by' url, and 'seconds'
+        - 'seconds': the time spent scanning url for candidates and in each tier
+        """
+        start = time.perf_counter()
+        parsers = list(self._candidate_parsers(url))
+        return self._trace_candidates(url, options, parsers, time.perf_counter() - start)
 
     def should_block_and_print(self, url, options=None):
-        """Check if url is in the patterns"""
-        if self.support_hash:
-            return self._should_block_with_hash()
-        blacklisted = False
-        for k in range(len(self.shortcut_sizes)):
-            shortcut_size = self.shortcut_sizes[k]
-            regex_map = self.all_shortcut_parser_maps[k]
-            for i in range(len(url) - shortcut_size + 1):
-                cur_sub = url[i:i+shortcut_size]
-                cur_sub = cur_sub.lower()
-                if cur_sub in regex_map:
-                    parser = regex_map[cur_sub]
-                    print("short: " + cur_sub)
-                    if blacklisted:
-                        if parser.is_whitelisted(url, options):
-                            print("Whitelisted by---------")
-                            parser.print_rules()
-                            return False
-                    else:
-                        state = parser.check(url, options)
-                        if state == 1:
-                            print("Whitelisted by---------")
-                            parser.print_rules()
-                            return False
-                        elif state == -1:
-                            print("Blacklisted by---------")
-                            parser.print_rules()
-                            blacklisted = True
-        if blacklisted:
-            if self.remaining_regex.is_whitelisted(url, options):
+        """Check if url is in the patterns, printing the candidates and the matching rules"""
+        record = self.trace(url, options)
+        for hit in record['hits']:
+            print("%s: %s" % (hit['tier'], hit['key']))
+            if hit['whitelisted_by']:
                 print("Whitelisted by---------")
-                parser.print_rules()
-                return False
-        else:
-            state = self.remaining_regex.check(url, options)
-            if state == 1:
-                print("Whitelisted by---------")
-                parser.print_rules()
-                return False
-            elif state == -1:
+                for rule in hit['whitelisted_by']:
+                    print(rule.strip())
+            if hit['blacklisted_by']:
                 print("Blacklisted by---------")
-                parser.print_rules()
-                blacklisted = True
-        return blacklisted
+                for rule in hit['blacklisted_by']:
+                    print(rule.strip())
+        return record['blocked']
 
     def should_block_with_items(self, url, options=None):
+        options = get_request_context(options)
+        signature = options.signature
         blacklisting_items = []
         blacklisted = False
-        for k in range(len(self.shortcut_sizes)):
-            shortcut_size = self.shortcut_sizes[k]
-            regex_map = self.all_shortcut_parser_maps[k]
-            for i in range(len(url) - shortcut_size + 1):
-                cur_sub = url[i:i+shortcut_size]
-                if cur_sub in regex_map:
-                    parser = regex_map[cur_sub]
-                    state, items = parser.check_with_items(url, options)
-                    if state == 1:
-                        return False, []
-                    elif state == -1:
-                        blacklisting_items += items
-                        blacklisted = True
-        state, items = self.remaining_regex.check_with_items(url, options)
+        for parser in self._candidate_parsers(url):
+            state, items = parser.check_with_items(url, options, signature)
+            if state == 1:
+                return False, []
+            elif state == -1:
+                blacklisting_items += items
+                blacklisted = True
+        state, items = self.remaining_regex.check_with_items(url, options, signature)
         if state == 1:
             return False, []
         elif state == -1:
@@ -141,6 +243,9 @@ class BlockListParser:
         else:
             return 0
 
+    def get_block_class_many(self, urls, options_list=None):
+        return [1 if block else 0 for block in self.should_block_many(urls, options_list)]
+
     def get_block_class_with_items(self, url, options=None):
         block, items = self.should_block_with_items(url, options)
         if block:
@@ -148,6 +253,126 @@ class BlockListParser:
         else:
             return 0, items
 
+    def apply_update(self, new_lines):
+        """Replaces the rules by new_lines, only rebuilding what the changed rules touch
+
+        Rules are diffed against the loaded ones: removed rules are taken out of the
+        host, shortcut or remaining_regex bucket holding them, added rules get a bucket
+        the way the initial build picks one, and only the parsers of those buckets are
+        rebuilt, with their rules in the order of new_lines. The shortcut scanner is only
+        rebuilt when shortcuts appear or disappear. Returns the number of added and
+        removed rules and of rebuilt buckets, and whether the shortcuts changed.
+
+        The rules left alone keep their shortcuts, while a build from new_lines picks
+        each shortcut given the rules before it. Rules with upper case letters are only
+        hit when their shortcut is lower case in the url too, so a few urls may get
+        another verdict than from a fresh build until the next one.
+        """
+        old_counts = Counter(self.regex_lines)
+        new_counts = Counter(new_lines)
+        locations = self._get_rule_locations()
+        bucket_lines = {}
+        num_removed = num_added = 0
+        for line, count in (old_counts - new_counts).items():
+            for _ in range(count):
+                # comments are not kept in any bucket
+                if locations.get(line):
+                    self._get_bucket_lines(bucket_lines, locations[line].pop()).remove(line)
+                num_removed += 1
+        for line, count in (new_counts - old_counts).items():
+            for _ in range(count):
+                location = self._locate_rule(line, bucket_lines)
+                if location is not None:
+                    self._get_bucket_lines(bucket_lines, location).append(line)
+                num_added += 1
+        positions = {}
+        for i, line in enumerate(new_lines):
+            positions.setdefault(line, i)
+        shortcuts_changed = False
+        for location, lines in bucket_lines.items():
+            lines.sort(key=positions.__getitem__)
+            if self._rebuild_bucket(location, lines):
+                shortcuts_changed = True
+        self.regex_lines = list(new_lines)
+        if self.host_cache is not None:
+            self.host_cache.clear()
+        if shortcuts_changed:
+            if self.support_hash:
+                self.all_shortcut_hash_maps = self._get_all_shortcut_hash_maps()
+            elif self.shortcut_automaton is not None:
+                self.shortcut_automaton = self._build_shortcut_automaton()
+        return {'added': num_added, 'removed': num_removed,
+                'rebuilt_buckets': len(bucket_lines), 'shortcuts_changed': shortcuts_changed}
+
+    def get_shortcut_report(self, url_corpus, top_n=10):
+        """Returns how many candidate parsers the urls of url_corpus are checked against
+        on average, and the top_n shortcuts hit by the most urls with their number of
+        rules, to assess a shortcut selection"""
+        shortcuts = dict((parser, shortcut) for _, shortcut, parser in self._shortcut_items())
+        shortcut_hits = Counter()
+        num_checks = 0
+        for url in url_corpus:
+            parsers = list(self._candidate_parsers(url))
+            num_checks += len(parsers)
+            shortcut_hits.update(set(shortcuts[parser] for parser in parsers if parser in shortcuts))
+        busiest = []
+        for shortcut, hits in shortcut_hits.most_common(top_n):
+            location = ('shortcut', self.shortcut_sizes.index(len(shortcut)), shortcut)
+            busiest.append((shortcut, hits, sum(len(parser.rules) for parser in self._get_bucket_parsers(location))))
+        return {'urls': len(url_corpus),
+                'candidate_checks_per_url': num_checks / float(len(url_corpus)) if url_corpus else 0.0,
+                'busiest_shortcuts': busiest}
+
+    def _trace_candidates(self, url, options, parsers, scan_seconds):
+        options = get_request_context(options)
+        signature = options.signature
+        labels = self._get_parser_labels()
+        record = {'url': url, 'hits': [], 'whitelisted_by': [], 'blacklisted_by': [],
+                  'seconds': {'scan': scan_seconds, 'host': 0.0, 'regex': 0.0, 'literal': 0.0, 'residue': 0.0}}
+        seen = set()
+        for parser in parsers + [self.remaining_regex]:
+            # a shortcut occurring several times in url yields its parsers each time
+            if parser in seen:
+                continue
+            seen.add(parser)
+            tier, key, size = labels.get(parser, ('residue', None, None))
+            start = time.perf_counter()
+            whitelisted_by = parser.is_whitelisted_with_items(url, options, signature)[1]
+            blacklisted_by = parser.is_blacklisted_with_items(url, options, signature)[1]
+            seconds = time.perf_counter() - start
+            record['hits'].append({'tier': tier, 'key': key, 'size': size, 'rules': len(parser.rules),
+                                   'whitelisted_by': whitelisted_by, 'blacklisted_by': blacklisted_by,
+                                   'seconds': seconds})
+            record['seconds'][tier] += seconds
+            record['whitelisted_by'] += whitelisted_by
+            record['blacklisted_by'] += blacklisted_by
+        if record['whitelisted_by']:
+            record['verdict'] = 1
+        elif record['blacklisted_by']:
+            record['verdict'] = -1
+        else:
+            record['verdict'] = 0
+        record['blocked'] = record['verdict'] == -1
+        return record
+
+    def _get_parser_labels(self):
+        """Maps each host and shortcut parser to its (tier, key, shortcut size)"""
+        labels = dict((parser, ('host', domain, None)) for domain, parser in self.host_parsers.items())
+        for k, shortcut, parser in self._shortcut_items():
+            tier = 'literal' if isinstance(parser, LiteralParser) else 'regex'
+            labels[parser] = (tier, shortcut, self.shortcut_sizes[k])
+        return labels
+
+    def get_cosmetic_selectors(self, domain, include_generic=True):
+        """Returns the element hiding selectors applying on pages of domain, see
+        CosmeticParser.get_selectors"""
+        return self.cosmetic_parser.get_selectors(domain, include_generic)
+
+    def get_residue_stats(self):
+        """Returns how many urls were checked against the rules without a shortcut, the
+        time spent on them, and how those rules are indexed"""
+        return self.remaining_regex.get_stats()
+
     @staticmethod
     def get_all_items(regex_file):
         with open(regex_file) as f:
@@ -161,37 +386,251 @@ class BlockListParser:
     def _convert_to_regex(self, lines):
         return Parser(lines)
 
-    def _should_block_with_hash(self, url, options):
-        blacklisted = False
+    def _candidate_parsers(self, url):
+        """Yields the HostParser of every host anchor of url, then the Parser of every
+        shortcut found in url, in one pass"""
+        host_parsers = self.host_parsers
+        for anchor in get_host_anchors(url):
+            parser = host_parsers.get(anchor)
+            if parser is not None:
+                yield parser
+        if self.support_hash:
+            for parser in self._candidate_parsers_with_hash(url):
+                yield parser
+            return
+        for _, parser in self.shortcut_automaton.iter_matches(url):
+            yield parser
+
+    def _cached_candidate_parsers(self, url):
+        """Returns the candidates of _candidate_parsers, through the host cache if there is
+        one: those found in the head of url (its scheme and authority) are taken from it,
+        without the rules which cannot match on its host"""
+        if self.host_cache is None or self.support_hash:
+            return self._candidate_parsers(url)
+        candidates = self.host_cache.get_candidates(url, self._head_candidate_parsers, self._iter_tagged_matches,
+                                                    max(self.shortcut_sizes))
+        if candidates is None:
+            return self._candidate_parsers(url)
+        return [parser for _, parser in candidates]
+
+    def _iter_tagged_matches(self, url, start):
+        for end, parser in self.shortcut_automaton.iter_matches(url, start):
+            yield end, (None, parser)
+
+    def _head_candidate_parsers(self, entry):
+        """Yields (None, parser) for the candidates of a url found in the head of entry alone"""
+        host_parsers = self.host_parsers
+        for anchor in self.host_cache.get_host_anchors(entry):
+            parser = host_parsers.get(anchor)
+            if parser is not None:
+                yield None, parser
+        for _, parser in self.shortcut_automaton.iter_matches(entry.head):
+            yield None, parser
+
+    def get_host_cache_stats(self):
+        """Returns the number of hosts in the host cache, its hits, misses and evictions,
+        the number of reduced parsers it holds, and how many candidate parsers and rules
+        it left out of url checks, or None if there is no host cache"""
+        if self.host_cache is None:
+            return None
+        return self.host_cache.stats()
+
+    def _candidate_parsers_with_hash(self, url):
+        """Yields the Parser of every shortcut found in url using rolling hashes
+
+        The prefix hashes of url are computed once and shared by every shortcut size;
+        a matching hash is verified against the shortcut text to rule out collisions.
+        """
+        prefix = self.fast_hashes[0].prefix_hashes(url)
+        for fast_hash, hash_map in zip(self.fast_hashes, self.all_shortcut_hash_maps):
+            for i, hash_value in enumerate(fast_hash.window_hashes(prefix)):
+                if hash_value in hash_map:
+                    for shortcut, parser in hash_map[hash_value]:
+                        if url.startswith(shortcut, i):
+                            yield parser
+
+    def _build_shortcut_automaton(self):
+        """Builds a single automaton over the shortcuts of every size"""
+        return AhoCorasick((shortcut, parser) for _, shortcut, parser in self._shortcut_items())
+
+    def _shortcut_items(self):
+        """Yields (size index, shortcut, parser) for the regex and literal parsers of every shortcut"""
         for k in range(len(self.shortcut_sizes)):
-            fast_hash = self.fast_hashes[k]
-            shortcut_size = self.shortcut_sizes[k]
-            regex_map = self.all_shortcut_parser_maps[k]
-            prev_hash = -1
-            for i in range(len(url) - shortcut_size + 1):
-                cur_hash = fast_hash.extend_hash(url, i, prev_hash)
-                if cur_hash in regex_map:
-                    parser = regex_map[cur_hash]
-                    if blacklisted:
-                        if parser.is_whitelisted(url, options):
-                            return False
+            for shortcut_map in (self.all_shortcut_parser_maps[k], self.all_shortcut_literal_maps[k]):
+                for shortcut, parser in shortcut_map.items():
+                    yield k, shortcut, parser
+
+    def _split_cosmetic_rules(self, lines):
+        """Returns the element hiding rules, and the other lines"""
+        cosmetic_lines = []
+        other_lines = []
+        for line in lines:
+            if CosmeticParser.is_cosmetic_rule(line):
+                cosmetic_lines.append(line)
+            else:
+                other_lines.append(line)
+        return cosmetic_lines, other_lines
+
+    def _split_host_rules(self, lines):
+        """Returns the ||domain^ rules grouped by domain, and the other lines"""
+        host_rule_map = defaultdict(list)
+        other_lines = []
+        for line in lines:
+            domain = HostParser.get_host_rule_domain(line)
+            if domain is None:
+                other_lines.append(line)
+            else:
+                host_rule_map[domain].append(line)
+        return host_rule_map, other_lines
+
+    def _get_host_parsers(self, host_rule_map):
+        return dict((domain, HostParser(lines)) for domain, lines in host_rule_map.items())
+
+    def _get_rule_locations(self):
+        """Maps each loaded line to the buckets holding it: ('cosmetic',), ('host', domain),
+        ('shortcut', size index, shortcut) or ('remaining',)"""
+        locations = defaultdict(list)
+        for line in self.cosmetic_parser.lines:
+            locations[line].append(('cosmetic',))
+        for domain, parser in self.host_parsers.items():
+            for rule in parser.rules:
+                locations[rule.raw_rule_text].append(('host', domain))
+        for k, shortcut, parser in self._shortcut_items():
+            for rule in parser.rules:
+                locations[rule.raw_rule_text].append(('shortcut', k, shortcut))
+        for rule in self.remaining_regex.rules:
+            locations[rule.raw_rule_text].append(('remaining',))
+        return locations
+
+    def _get_bucket_parsers(self, location):
+        if location[0] == 'host':
+            parser = self.host_parsers.get(location[1])
+            return [parser] if parser is not None else []
+        if location[0] == 'remaining':
+            return [self.remaining_regex]
+        _, k, shortcut = location
+        return [shortcut_map[shortcut]
+                for shortcut_map in (self.all_shortcut_parser_maps[k], self.all_shortcut_literal_maps[k])
+                if shortcut in shortcut_map]
+
+    def _get_bucket_lines(self, bucket_lines, location):
+        """Returns the lines of a bucket being updated, loaded from its parsers on first use"""
+        if location not in bucket_lines:
+            if location[0] == 'cosmetic':
+                bucket_lines[location] = list(self.cosmetic_parser.lines)
+            else:
+                bucket_lines[location] = [rule.raw_rule_text
+                                          for parser in self._get_bucket_parsers(location)
+                                          for rule in parser.rules]
+        return bucket_lines[location]
+
+    def _locate_rule(self, line, bucket_lines):
+        """Returns the bucket of a new line, chosen as in the initial build, or None for comments"""
+        if CosmeticParser.is_cosmetic_rule(line):
+            return ('cosmetic',)
+        domain = HostParser.get_host_rule_domain(line)
+        if domain is not None:
+            return ('host', domain)
+        if line[0] == '!':
+            return None
+        url = re.split(r'\$+', line)[0]
+        for k, shortcut_size in enumerate(self.shortcut_sizes):
+            searches = self._get_shortcut_pattern(shortcut_size).findall(url)
+            if searches:
+                def get_load(cur_s):
+                    location = ('shortcut', k, cur_s)
+                    if location in bucket_lines:
+                        lines = bucket_lines[location]
                     else:
-                        state = parser.check(url, options)
-                        if state == 1:
-                            return False
-                        elif state == -1:
-                            blacklisted = True
-                prev_hash = cur_hash
-        if blacklisted:
-            if self.remaining_regex.is_whitelisted(url, options):
-                return False
+                        lines = [rule for parser in self._get_bucket_parsers(location) for rule in parser.rules]
+                    return len(lines) or None
+                return ('shortcut', k, self._select_shortcut(searches, shortcut_size, get_load,
+                                                             self.shortcut_frequencies))
+        return ('remaining',)
+
+    def _rebuild_bucket(self, location, lines):
+        """Rebuilds the parsers of a bucket from its lines, returns whether the
+        (shortcut, parser) pairs scanned for changed"""
+        if location[0] == 'cosmetic':
+            self.cosmetic_parser = CosmeticParser(lines)
+            return False
+        if location[0] == 'host':
+            parser = self.host_parsers.get(location[1])
+            if not lines:
+                self.host_parsers.pop(location[1], None)
+            elif parser is None:
+                self.host_parsers[location[1]] = HostParser(lines)
+            else:
+                _reload_parser(parser, lines)
+            return False
+        if location[0] == 'remaining':
+            _reload_parser(self.remaining_regex, lines)
+            return False
+        _, k, shortcut = location
+        literal_lines = [line for line in lines if LiteralParser.is_literal_rule(line)]
+        regex_lines = [line for line in lines if not LiteralParser.is_literal_rule(line)]
+        changed = False
+        for shortcut_map, map_lines, parser_cls in (
+                (self.all_shortcut_parser_maps[k], regex_lines, self._convert_to_regex),
+                (self.all_shortcut_literal_maps[k], literal_lines, LiteralParser)):
+            parser = shortcut_map.get(shortcut)
+            if not map_lines:
+                if parser is not None:
+                    del shortcut_map[shortcut]
+                    changed = True
+            elif parser is None:
+                shortcut_map[shortcut] = parser_cls(map_lines)
+                changed = True
+            else:
+                _reload_parser(parser, map_lines)
+        return changed
+
+    def _get_cache_path(self, cache_dir, regex_file, regex_lines, build_automaton=True, url_corpus=None):
+        """Returns the path of the pickle of the maps, and the start of the names of the
+        pickles of any version of the same list (None for rules not read from a file)"""
+        # joined on a character no line holds, so that different lines never hash alike
+        digest = hashlib.sha256('\0'.join(regex_lines).encode('utf8')).hexdigest()
+        if self.support_hash:
+            scanner = '-hash'
+        elif not build_automaton:
+            scanner = '-noscan'
         else:
-            state = self.remaining_regex.check(url, options)
-            if state == 1:
-                return False
-            elif state == -1:
-                blacklisted = True
-        return blacklisted
+            scanner = ''
+        if url_corpus is not None:
+            scanner += '-corpus' + hashlib.sha256('\n'.join(url_corpus).encode('utf8')).hexdigest()[:16]
+        if regex_file is None:
+            list_prefix = None
+            name = 'blocklist-'
+        else:
+            list_prefix = name = 'blocklist-%s-' % os.path.splitext(os.path.basename(regex_file))[0]
+        name += '%s-%s%s.v%d.pickle' % (digest, '-'.join(str(size) for size in self.shortcut_sizes),
+                                         scanner, self.CACHE_VERSION)
+        return os.path.join(cache_dir, name), list_prefix
+
+    def _load_cache(self, cache_path):
+        """Restores the maps from cache_path, returns False if it is missing or unusable"""
+        state = load_cache(cache_path, self.CACHE_VERSION)
+        if state is None:
+            return False
+        state['print_maps'] = self.print_maps
+        # the host cache is sized as asked, whatever the size it was saved with
+        del state['host_cache']
+        self.__dict__.update(state)
+        return True
+
+    def _save_cache(self, cache_path, list_prefix=None):
+        save_cache(cache_path, self.CACHE_VERSION, self.__getstate__(), list_prefix)
+
+    def __getstate__(self):
+        # the host cache only holds what was derived from the urls checked so far, so
+        # only its size is kept
+        state = self.__dict__.copy()
+        state['host_cache'] = _get_host_cache_size(self.host_cache)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.host_cache = _make_host_cache(state['host_cache'])
 
     def _print_num_map(self, shortcut_url_map):
         num_shortcuts = {}
@@ -230,59 +669,419 @@ class BlockListParser:
             total_rules += 1
             url = re.split(r'\$+', line)[0]
             searches = pat.findall(url)
-            flag = 0
             if searches:
                 total_shortcuts += 1
             else:
                 secondary_lines.append(line)
                 continue
-            min_count = -1
-            for s in searches:
-                s = s.lower()
-                for i in range(len(s) - shortcut_size+1):
-                    cur_s = s[i:i+shortcut_size]
-                    if cur_s not in shortcut_url_map:
-                        shortcut_url_map[cur_s] = [line]
-                        flag = 1
-                        break
-                    if min_count == -1 or len(shortcut_url_map[cur_s]) < min_count:
-                        min_count = len(shortcut_url_map[cur_s])
-                        min_s = cur_s
-                if flag == 1:
-                    break
-            if flag == 0:
-                shortcut_url_map[min_s].append(line)
+            shortcut = self._select_shortcut(
+                searches, shortcut_size,
+                lambda cur_s: len(shortcut_url_map[cur_s]) if cur_s in shortcut_url_map else None,
+                self.shortcut_frequencies)
+            shortcut_url_map.setdefault(shortcut, []).append(line)
         if self.print_maps:
             self._print_statistics_of_map(shortcut_size, total_rules, total_comments,
                                           total_shortcuts, len(secondary_lines), shortcut_url_map)
         return shortcut_url_map, secondary_lines
 
+    @staticmethod
+    def _select_shortcut(searches, shortcut_size, get_load, frequencies=None):
+        """Returns the first n-gram of searches not used as a shortcut yet, or else the
+        one holding the fewest rules; get_load returns the number of rules held by a
+        shortcut, or None if it is unused.
+
+        With frequencies, the number of sample urls holding each n-gram, returns the
+        n-gram found in the fewest urls instead, the least loaded one among those.
+        N-grams with upper case letters come last: urls are scanned for the lower case
+        shortcut while the rule matches case-sensitively, so they are never hit.
+        """
+        if frequencies is not None:
+            ngrams = [s[i:i+shortcut_size] for s in searches for i in range(len(s) - shortcut_size+1)]
+            best = min(ngrams, key=lambda cur_s: (cur_s != cur_s.lower(), frequencies.get(cur_s.lower(), 0),
+                                                  get_load(cur_s.lower()) or 0))
+            return best.lower()
+        min_count = -1
+        for s in searches:
+            s = s.lower()
+            for i in range(len(s) - shortcut_size+1):
+                cur_s = s[i:i+shortcut_size]
+                count = get_load(cur_s)
+                if count is None:
+                    return cur_s
+                if min_count == -1 or count < min_count:
+                    min_count = count
+                    min_s = cur_s
+        return min_s
+
+    @staticmethod
+    def _get_shortcut_pattern(shortcut_size):
+        return re.compile(r'[\w\/\=\.\-\?\;\,\&]{%d,}' % shortcut_size)
+
+    def _count_shortcut_frequencies(self, lines, url_corpus):
+        """Counts the urls of url_corpus holding each n-gram a rule of lines may get as its
+        shortcut, that is each n-gram of the first shortcut size the rule has searches for"""
+        candidates = [set() for _ in self.shortcut_sizes]
+        pats = [self._get_shortcut_pattern(shortcut_size) for shortcut_size in self.shortcut_sizes]
+        for line in lines:
+            if line[0] == '!':
+                continue
+            url = re.split(r'\$+', line)[0]
+            for k, shortcut_size in enumerate(self.shortcut_sizes):
+                searches = pats[k].findall(url)
+                if searches:
+                    for s in searches:
+                        s = s.lower()
+                        candidates[k].update(s[i:i+shortcut_size] for i in range(len(s) - shortcut_size+1))
+                    break
+        frequencies = Counter()
+        for url in url_corpus:
+            for k, shortcut_size in enumerate(self.shortcut_sizes):
+                ngrams = set(url[i:i+shortcut_size] for i in range(len(url) - shortcut_size+1))
+                frequencies.update(ngrams & candidates[k])
+        return dict(frequencies)
+
     def _get_all_shortcut_url_maps(self, lines):
         all_shortcut_url_maps = []
         for shortcut_size in self.shortcut_sizes:
-            pat = re.compile(r'[\w\/\=\.\-\?\;\,\&]{%d,}' % shortcut_size)
+            pat = self._get_shortcut_pattern(shortcut_size)
             shortcut_url_map, lines = self._get_shortcut_url_map(pat, lines, shortcut_size)
             all_shortcut_url_maps.append(shortcut_url_map)
         return all_shortcut_url_maps, lines
 
-    def _get_shortcut_parser_map(self, fast_hash, shortcut_url_map):
+    def _get_shortcut_parser_map(self, shortcut_url_map):
+        """Returns the shortcut to Parser map of the regex rules, and the shortcut to
+        LiteralParser map of the plain substring rules"""
         shortcut_parser_map = {}
-        if self.support_hash:
-            for shortcut in shortcut_url_map:
-                hash_value = fast_hash.compute_hash(shortcut)
-                if hash_value in shortcut_parser_map:
-                    shortcut_parser_map[hash_value].append(shortcut_url_map[shortcut])
+        shortcut_literal_map = {}
+        for shortcut in shortcut_url_map:
+            literal_lines = []
+            regex_lines = []
+            for line in shortcut_url_map[shortcut]:
+                if LiteralParser.is_literal_rule(line):
+                    literal_lines.append(line)
                 else:
-                    shortcut_parser_map[hash_value] = shortcut_url_map[shortcut]
-            for hash_key in shortcut_parser_map:
-                shortcut_parser_map[hash_key] = self._convert_to_regex(shortcut_parser_map[hash_key])
-        else:
-            for shortcut in shortcut_url_map:
-                shortcut_parser_map[shortcut] = self._convert_to_regex(shortcut_url_map[shortcut])
-        return shortcut_parser_map
+                    regex_lines.append(line)
+            if regex_lines:
+                shortcut_parser_map[shortcut] = self._convert_to_regex(regex_lines)
+            if literal_lines:
+                shortcut_literal_map[shortcut] = LiteralParser(literal_lines)
+        return shortcut_parser_map, shortcut_literal_map
 
     def _get_all_shortcut_parser_maps(self, all_shortcut_url_maps):
         all_shortcut_parser_maps = []
-        for fast_hash, shortcut_url_map in zip(self.fast_hashes, all_shortcut_url_maps):
-            all_shortcut_parser_maps.append(self._get_shortcut_parser_map(fast_hash, shortcut_url_map))
-        return all_shortcut_parser_maps
+        all_shortcut_literal_maps = []
+        for shortcut_url_map in all_shortcut_url_maps:
+            shortcut_parser_map, shortcut_literal_map = self._get_shortcut_parser_map(shortcut_url_map)
+            all_shortcut_parser_maps.append(shortcut_parser_map)
+            all_shortcut_literal_maps.append(shortcut_literal_map)
+        return all_shortcut_parser_maps, all_shortcut_literal_maps
+
+    def _get_all_shortcut_hash_maps(self):
+        """Maps, for each shortcut size, each hash to the (shortcut, parser) pairs sharing it"""
+        all_shortcut_hash_maps = [defaultdict(tuple) for _ in self.shortcut_sizes]
+        for k, shortcut, parser in self._shortcut_items():
+            all_shortcut_hash_maps[k][self.fast_hashes[k].compute_hash(shortcut)] += ((shortcut, parser),)
+        return [dict(shortcut_hash_map) for shortcut_hash_map in all_shortcut_hash_maps]
+
+
+class CombinedBlockListParser:
+    """Checks urls against several block lists with a single shortcut scan
+
+    The shortcuts of every list are loaded into one automaton whose outputs are
+    tagged with the list they come from, so one pass over a url yields the
+    candidate Parsers of all lists, and the verdict of each list is kept apart.
+    """
+
+    # the pickled state is made of BlockListParser maps, so it follows their version
+    CACHE_VERSION = BlockListParser.CACHE_VERSION
+
+    def __init__(self, regex_files, shortcut_sizes=None, cache_dir=None, url_corpus=None,
+                 host_cache_size=None):
+        """regex_files is a list of (list_name, regex_file) pairs.
+
+        If cache_dir is given, the combined parser is pickled there under a name derived
+        from the names of the lists and the SHA-256 of every list, as for BlockListParser. url_corpus is passed on to
+        the BlockListParser of every list, and host_cache_size is the size of the
+        HostCandidateCache shared by the lists, if any.
+        """
+        self.list_names = [list_name for list_name, _ in regex_files]
+        self.host_cache = _make_host_cache(host_cache_size)
+        if cache_dir is not None:
+            contents = []
+            for _, regex_file in regex_files:
+                with open(regex_file) as f:
+                    contents.append(f.read())
+            if url_corpus is not None:
+                contents.append('\n'.join(url_corpus))
+            digest = hashlib.sha256('\0'.join(contents).encode('utf8')).hexdigest()
+            list_prefix = 'combined-%s-' % '-'.join(self.list_names)
+            cache_path = os.path.join(cache_dir, '%s%s%s.v%d.pickle' % (
+                list_prefix, digest, ''.join('-%d' % size for size in shortcut_sizes or []), self.CACHE_VERSION))
+            state = load_cache(cache_path, self.CACHE_VERSION)
+            if state is not None:
+                del state['host_cache']
+                self.__dict__.update(state)
+                return
+        self.parsers = [BlockListParser(regex_file, shortcut_sizes=shortcut_sizes, build_automaton=False,
+                                        url_corpus=url_corpus)
+                        for _, regex_file in regex_files]
+        self.shortcut_automaton = self._build_shortcut_automaton()
+        self.host_parsers = self._get_host_parsers()
+        if cache_dir is not None:
+            save_cache(cache_path, self.CACHE_VERSION, self.__getstate__(), list_prefix)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['host_cache'] = _get_host_cache_size(self.host_cache)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.host_cache = _make_host_cache(state['host_cache'])
+
+    def get_parser(self, list_name):
+        """Returns the BlockListParser of list_name (which cannot scan urls on its own)"""
+        return self.parsers[self.list_names.index(list_name)]
+
+    def check(self, url, options=None, list_names=None):
+        """Returns a dict mapping each list name (or only those in list_names) to 1 if
+        that list whitelists url, -1 if it blacklists it and does not whitelist it,
+        and 0 otherwise"""
+        indices = self._get_indices(list_names)
+        candidates = self._cached_candidate_parsers(url)
+        options = get_request_context(options)
+        signature = options.signature
+        return dict((self.list_names[index],
+                     self.parsers[index]._check_candidates(url, options, signature, candidates[index]))
+                    for index in indices)
+
+    def check_with_domain_sensitivity(self, url, options=None, list_names=None):
+        """Returns a dict mapping each list name to the pair of check's verdict and whether
+        that list's verdict may change with the first-party domain"""
+        indices = self._get_indices(list_names)
+        candidates = self._cached_candidate_parsers(url)
+        options = get_request_context(options)
+        signature = options.signature
+        result = {}
+        for index in indices:
+            parser = self.parsers[index]
+            result[self.list_names[index]] = (
+                parser._check_candidates(url, options, signature, candidates[index]),
+                parser._is_domain_sensitive(options, signature, candidates[index]))
+        return result
+
+    def should_block(self, url, options=None, list_names=None):
+        """Returns a dict mapping each list name to whether that list blocks url"""
+        return dict((list_name, state == -1)
+                    for list_name, state in self.check(url, options, list_names).items())
+
+    def check_many(self, urls, options_list=None, list_names=None):
+        """Like check for a batch of urls, classified as in BlockListParser.should_block_many"""
+        indices = self._get_indices(list_names)
+        unique_urls, unique_options, unique_signatures, positions = _deduplicate(urls, options_list)
+        candidates = [self._cached_candidate_parsers(url) for url in unique_urls]
+        states = [(self.list_names[index],
+                   self.parsers[index]._check_many(unique_urls, unique_options, unique_signatures,
+                                                   [url_candidates[index] for url_candidates in candidates]))
+                  for index in indices]
+        return [dict((list_name, list_states[i]) for list_name, list_states in states) for i in positions]
+
+    def should_block_many(self, urls, options_list=None, list_names=None):
+        return [dict((list_name, state == -1) for list_name, state in url_states.items())
+                for url_states in self.check_many(urls, options_list, list_names)]
+
+    def trace(self, url, options=None, list_names=None):
+        """Returns a dict mapping each list name to BlockListParser.trace's record of url"""
+        start = time.perf_counter()
+        candidates = self._candidate_parsers(url)
+        scan_seconds = time.perf_counter() - start
+        return dict((self.list_names[index],
+                     self.parsers[index]._trace_candidates(url, options, candidates[index], scan_seconds))
+                    for index in self._get_indices(list_names))
+
+    def get_cosmetic_selectors(self, domain, include_generic=True, list_names=None):
+        """Returns a dict mapping each list name to the element hiding selectors it
+        applies on pages of domain"""
+        return dict((self.list_names[index], self.parsers[index].get_cosmetic_selectors(domain, include_generic))
+                    for index in self._get_indices(list_names))
+
+    def get_residue_stats(self):
+        """Returns BlockListParser.get_residue_stats for each list"""
+        return dict((list_name, parser.get_residue_stats())
+                    for list_name, parser in zip(self.list_names, self.parsers))
+
+    def apply_update(self, list_name, new_lines):
+        """Replaces the rules of list_name by new_lines, as in BlockListParser.apply_update"""
+        result = self.get_parser(list_name).apply_update(new_lines)
+        if result['shortcuts_changed']:
+            self.shortcut_automaton = self._build_shortcut_automaton()
+        self.host_parsers = self._get_host_parsers()
+        if self.host_cache is not None:
+            self.host_cache.clear()
+        return result
+
+    def get_host_cache_stats(self):
+        """Returns BlockListParser.get_host_cache_stats for the host cache of the lists"""
+        if self.host_cache is None:
+            return None
+        return self.host_cache.stats()
+
+    def _build_shortcut_automaton(self):
+        return AhoCorasick((shortcut, (index, parser))
+                           for index, blocklist_parser in enumerate(self.parsers)
+                           for _, shortcut, parser in blocklist_parser._shortcut_items())
+
+    def _get_host_parsers(self):
+        """Merges the host tiers of every list into one dict of tagged HostParsers"""
+        host_parsers = defaultdict(tuple)
+        for index, blocklist_parser in enumerate(self.parsers):
+            for domain, parser in blocklist_parser.host_parsers.items():
+                host_parsers[domain] += ((index, parser),)
+        return dict(host_parsers)
+
+    def _get_indices(self, list_names):
+        if list_names is None:
+            return range(len(self.list_names))
+        return [self.list_names.index(list_name) for list_name in list_names]
+
+    def _candidate_parsers(self, url):
+        """Returns the candidate Parsers of url for each list, found in one pass"""
+        candidates = [[] for _ in self.parsers]
+        host_parsers = self.host_parsers
+        for anchor in get_host_anchors(url):
+            for index, parser in host_parsers.get(anchor, ()):
+                candidates[index].append(parser)
+        for _, (index, parser) in self.shortcut_automaton.iter_matches(url):
+            candidates[index].append(parser)
+        return candidates
+
+    def _cached_candidate_parsers(self, url):
+        """Like _candidate_parsers, through the host cache as in
+        BlockListParser._cached_candidate_parsers"""
+        if self.host_cache is None:
+            return self._candidate_parsers(url)
+        # tagged with the index of their list
+        tagged = self.host_cache.get_candidates(url, self._head_candidate_parsers,
+                                                self.shortcut_automaton.iter_matches,
+                                                max(max(parser.shortcut_sizes) for parser in self.parsers))
+        if tagged is None:
+            return self._candidate_parsers(url)
+        candidates = [[] for _ in self.parsers]
+        for index, parser in tagged:
+            candidates[index].append(parser)
+        return candidates
+
+    def _head_candidate_parsers(self, entry):
+        """Yields (list index, parser) for the candidates of a url found in the head of entry alone"""
+        host_parsers = self.host_parsers
+        for anchor in self.host_cache.get_host_anchors(entry):
+            for item in host_parsers.get(anchor, ()):
+                yield item
+        for _, item in self.shortcut_automaton.iter_matches(entry.head):
+            yield item
+
+
+def _make_host_cache(host_cache_size):
+    """Returns a HostCandidateCache of host_cache_size hosts, or None if it is None or 0"""
+    return HostCandidateCache(host_cache_size) if host_cache_size else None
+
+
+def _get_host_cache_size(host_cache):
+    return host_cache.maxsize if host_cache is not None else None
+
+
+def _reload_parser(parser, lines):
+    # rebuilt in place, since the shortcut scanners hold references to the parser
+    parser.__init__(lines)
+
+
+def _deduplicate(urls, options_list):
+    """Returns the distinct (url, options) pairs of a batch, with their options as
+    RequestContexts, their options signatures, and the position of each pair of the
+    batch among the distinct ones"""
+    if options_list is None:
+        options_list = [None] * len(urls)
+    unique_index = {}
+    unique_urls = []
+    unique_options = []
+    unique_signatures = []
+    positions = []
+    for url, options in zip(urls, options_list):
+        options = get_request_context(options)
+        signature = options.signature
+        key = (url, signature, options.domain)
+        if key not in unique_index:
+            unique_index[key] = len(unique_urls)
+            unique_urls.append(url)
+            unique_options.append(options)
+            unique_signatures.append(signature)
+        positions.append(unique_index[key])
+    return unique_urls, unique_options, unique_signatures, positions
+
+
+def load_cache(cache_path, cache_version):
+    """Returns the state pickled at cache_path, or None if it is missing or unusable"""
+    # the cyclic collector would otherwise run over and over while
+    # tens of thousands of rule objects are being unpickled
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception:
+        return None
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    if cached.get('cache_version') != cache_version:
+        return None
+    return cached['state']
+
+
+def save_cache(cache_path, cache_version, state, list_prefix=None):
+    """Pickles state to cache_path, then removes the stale pickles next to it: those of
+    another cache_version, and those named list_prefix followed by another digest than
+    cache_path's, left by older versions of the same lists. Failing to write the cache
+    is not fatal"""
+    cached = {'cache_version': cache_version, 'state': state}
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+    _remove_stale_caches(cache_path, cache_version, list_prefix)
+
+
+# the pickles written by save_cache, with their cache version
+_CACHE_NAME_RE = re.compile(r'(?:blocklist|combined)-.*\.v(\d+)\.pickle\Z')
+_DIGEST_RE = re.compile(r'[0-9a-f]{64}[-.]')
+
+def _remove_stale_caches(cache_path, cache_version, list_prefix):
+    cache_dir, name = os.path.split(cache_path)
+    try:
+        names = os.listdir(cache_dir or '.')
+    except OSError:
+        return
+    if list_prefix is not None:
+        start = len(list_prefix)
+        digest = name[start:start + 64]
+    for other in names:
+        match = _CACHE_NAME_RE.match(other)
+        if match is None or other == name:
+            continue
+        stale = int(match.group(1)) != cache_version
+        # the digest follows the list names, which may be the start of other list names
+        if not stale and list_prefix is not None and other.startswith(list_prefix):
+            stale = _DIGEST_RE.match(other, start) is not None and other[start:start + 64] != digest
+        if stale:
+            try:
+                os.remove(os.path.join(cache_dir, other))
+            except OSError:
+                pass
@@ -0,0 +1,97 @@
+import collections
+import multiprocessing
+import os
+
+# the function classifying a chunk of items in a worker, inherited from the parent at the fork
+_classify_chunk = None
+
+def _init_worker(classify_chunk):
+    global _classify_chunk
+    _classify_chunk = classify_chunk
+
+def _run_chunk(chunk):
+    return _classify_chunk(chunk)
+
+
+class ClassificationPool:
+    """Pool of worker processes classifying chunks of items with classify_chunk.
+
+    The workers are forked from this process when the pool is created, so the
+    blocklist engines classify_chunk uses must be loaded before then: the workers
+    share their memory copy-on-write instead of each building or unpickling them.
+    classify_chunk takes a list of items and returns the list of their results.
+
+    Where fork is not available, or with processes=1, items are classified in this
+    process.
+
+    At most max_pending_chunks chunks (twice the number of processes by default) are
+    handed to the workers at a time, so imap only reads its items that far ahead.
+    """
+
+    def __init__(self, classify_chunk, processes=None, chunk_size=500, max_pending_chunks=None):
+        self.classify_chunk = classify_chunk
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.max_pending_chunks = max_pending_chunks or 2 * self.processes
+        if self.processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            # with fork, the initializer and its arguments are inherited rather than pickled
+            self.pool = multiprocessing.get_context('fork').Pool(
+                self.processes, initializer=_init_worker, initargs=(classify_chunk,))
+        else:
+            self.pool = None
+
+    def imap(self, items):
+        """Yields the result of each of items, in order, as soon as its chunk is classified.
+        items may be any iterable, and is read at most max_pending_chunks chunks ahead
+        of the results yielded."""
+        chunks = _get_chunks(items, self.chunk_size)
+        if self.pool is None:
+            for chunk in chunks:
+                for result in self.classify_chunk(chunk):
+                    yield result
+            return
+        # Pool.imap would read all of items up front from its task thread
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(self.pool.apply_async(_run_chunk, (chunk,)))
+            if len(pending) >= self.max_pending_chunks:
+                for result in pending.popleft().get():
+                    yield result
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+
+    def map(self, items):
+        return list(self.imap(items))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def _get_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from DomainTrie import DomainTrie
+
+class CosmeticParser:
+    """Index of element hiding rules (domains##selector and exceptions domains#@#selector)
+    by the domains they are restricted to"""
+
+    def __init__(self, lines):
+        self.lines = list(lines)
+        # rule id -> (selector, is_exception)
+        self.rules = []
+        # ids of the rules listing no domain to apply on, which apply on every domain
+        # except those they exclude
+        self.generic_rules = []
+        domain_entries = []
+        for line in self.lines:
+            rule_text = line.strip()
+            is_exception = '#@#' in rule_text
+            domains_text, selector = rule_text.split('#@#' if is_exception else '##', 1)
+            rule_id = len(self.rules)
+            self.rules.append((selector, is_exception))
+            domains = [domain.strip() for domain in domains_text.split(',') if domain.strip()]
+            for domain in domains:
+                domain_entries.append((domain.lstrip('~'), rule_id, not domain.startswith('~')))
+            if not any(not domain.startswith('~') for domain in domains):
+                self.generic_rules.append(rule_id)
+        self.domain_trie = DomainTrie(domain_entries)
+        self.generic_rule_ids = frozenset(self.generic_rules)
+        self.generic_exception_ids = [rule_id for rule_id in self.generic_rules if self.rules[rule_id][1]]
+        # the selectors of the generic non-exception rules, each once, in list order
+        self.generic_selectors = list(OrderedDict.fromkeys(
+            self.rules[rule_id][0] for rule_id in self.generic_rules if not self.rules[rule_id][1]))
+        self.generic_selector_set = frozenset(self.generic_selectors)
+
+    def __len__(self):
+        return len(self.rules)
+
+    @staticmethod
+    def is_cosmetic_rule(line):
+        """Whether SingleRuleParser would take the rule on line for an element hiding rule"""
+        line = line.strip()
+        return not line.startswith(('!', '[Adblock')) and ('##' in line or '#@#' in line)
+
+    def get_selectors(self, domain, include_generic=True):
+        """Returns the selectors hidden on pages of domain: those of the rules restricted
+        to domain first, then those of the generic rules, each once and in list order.
+
+        A rule applies if the most specific of domain and its parent domains it lists is
+        included, or if it lists none of them and no domain to apply on. Selectors of
+        the applying exception rules are left out. include_generic=False leaves out the
+        rules applying on every domain, which are the bulk of a list.
+        """
+        matched = self.domain_trie.lookup(domain) if domain else {}
+        # generic rules which list domain among their exclusions
+        excluding = set(rule_id for rule_id in matched if rule_id in self.generic_rule_ids)
+        specific = sorted(rule_id for rule_id, included in matched.items() if included)
+        excepted = set(self.rules[rule_id][0] for rule_id in specific if self.rules[rule_id][1])
+        excepted.update(self.rules[rule_id][0] for rule_id in self.generic_exception_ids
+                        if rule_id not in excluding)
+        selectors = []
+        for rule_id in specific:
+            selector, is_exception = self.rules[rule_id]
+            if not is_exception and selector not in excepted:
+                selectors.append(selector)
+        if include_generic:
+            if excluding:
+                # a selector may come from several generic rules, not all of them excluding domain
+                generic_selectors = [selector for selector in OrderedDict.fromkeys(
+                                         self.rules[rule_id][0] for rule_id in self.generic_rules
+                                         if not self.rules[rule_id][1] and rule_id not in excluding)
+                                     if selector not in excepted]
+            elif excepted & self.generic_selector_set:
+                generic_selectors = [selector for selector in self.generic_selectors if selector not in excepted]
+            else:
+                generic_selectors = list(self.generic_selectors)
+            selectors = [selector for selector in selectors if selector not in self.generic_selector_set]
+        else:
+            generic_selectors = []
+        return list(OrderedDict.fromkeys(selectors)) + generic_selectors
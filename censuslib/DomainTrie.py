@@ -0,0 +1,48 @@
+class DomainTrie:
+    """Trie over the labels of domain names in reverse order (com -> example -> www)
+
+    Every node may hold (value, flag) entries, so all the entries stored for a
+    domain and for each of its parent domains are found in a single walk."""
+
+    def __init__(self, items=None):
+        """Builds the trie from an iterable of (domain, value, flag) triples"""
+        # a node is [children, entries]
+        self.root = [{}, []]
+        if items:
+            for domain, value, flag in items:
+                self.add(domain, value, flag)
+
+    def __len__(self):
+        return self._count(self.root)
+
+    def _count(self, node):
+        return len(node[1]) + sum(self._count(child) for child in node[0].values())
+
+    def add(self, domain, value, flag=True):
+        node = self.root
+        for label in reversed(domain.split('.')):
+            child = node[0].get(label)
+            if child is None:
+                child = node[0][label] = [{}, []]
+            node = child
+        node[1].append((value, flag))
+
+    def walk(self, domain, min_labels=1):
+        """Yields the entries of the nodes on the path of domain, from the top-level
+        label down, skipping the nodes of domains shorter than min_labels labels"""
+        node = self.root
+        depth = 0
+        for label in reversed(domain.split('.')):
+            node = node[0].get(label)
+            if node is None:
+                return
+            depth += 1
+            if depth >= min_labels:
+                for entry in node[1]:
+                    yield entry
+
+    def lookup(self, domain, min_labels=1):
+        """Returns {value: flag} for the values stored on domain or on one of its
+        parent domains; when a value is stored at several levels the flag of the
+        most specific domain wins"""
+        return dict(self.walk(domain, min_labels))
@@ -9,6 +9,8 @@ class FastHash:
         self.multipliers = []
         for i in reversed(range(self.M)):
             self.multipliers.append((self.R**i)%self.Q)
+        # weight of the character leaving a window, R^M (mod Q)
+        self.RM = (self.R**self.M)%self.Q
 
     def compute_hash(self, s, start_index = 0):
         if (len(s) - start_index) < self.M:
@@ -27,3 +29,26 @@ class FastHash:
             return -1
         hash_value = ((prev_hash - ord(s[start_index-1])*self.multipliers[0])*self.R + ord(s[start_index + self.M - 1]))%self.Q
         return hash_value
+
+    def prefix_hashes(self, s):
+        """Returns h where h[i] is the hash of s[:i].
+
+        The prefix hashes do not depend on M, so one list can be shared by the
+        FastHash of every string size to compute all of their window hashes."""
+        R = self.R
+        Q = self.Q
+        hash_value = 0
+        prefix = [0]
+        append = prefix.append
+        for ch in s:
+            hash_value = (hash_value*R + ord(ch))%Q
+            append(hash_value)
+        return prefix
+
+    def window_hashes(self, prefix):
+        """Returns the hash of every window of size M, given the prefix hashes of
+        the string: hash(s[i:i+M]) = h[i+M] - h[i]*R^M (mod Q)"""
+        M = self.M
+        RM = self.RM
+        Q = self.Q
+        return [(prefix[i+M] - prefix[i]*RM)%Q for i in range(len(prefix) - M)]
@@ -0,0 +1,223 @@
+from LRUCache import LRUCache
+from PlainRuleParser import URL_HEAD_RE, get_host_anchor_starts, get_host_anchors
+from RegexParser import Parser
+
+HOST_CACHE_SIZE = 4096
+# how many reduced Parsers are kept, whatever the number of heads: they are few and
+# shared by many heads, and building one again costs far more than a head
+REDUCED_PARSER_CACHE_SIZE = 1024
+# how many parsers a head keeps the reduction of
+MAX_HEAD_REDUCTIONS = 64
+
+
+class HostEntry:
+    """What is cached for one url head"""
+
+    __slots__ = ('head', 'starts', 'candidates', 'num_pruned_parsers', 'num_pruned_rules', 'reduced')
+
+    def __init__(self, head):
+        self.head = head
+        # the positions of head a ||domain rule may start matching at, worked out with
+        # the candidates
+        self.starts = None
+        # (tag, parser, kept) for the candidates found in the head alone, filled in by the
+        # parser using the cache, kept being as in reduced
+        self.candidates = None
+        # how many parsers and rules were left out of those
+        self.num_pruned_parsers = 0
+        self.num_pruned_rules = 0
+        # parser -> (the indices of its rules which may match, None if all of them, and the
+        # number of rules left out), for at most MAX_HEAD_REDUCTIONS parsers; the reduced
+        # Parsers are only held by the cache
+        self.reduced = {}
+
+
+class HostCandidateCache:
+    """The candidates of a url which only depend on its head (its scheme and authority),
+    computed once per head.
+
+    For each head, it keeps the candidates found in the head alone, that is the
+    HostParsers of its host anchors and the Parsers of the shortcuts it holds, so only
+    the rest of a url with that head has to be scanned. Parsers are also reduced to
+    the rules which may match urls with that head: rules anchored at the start of the
+    url (|http://...) or at a label of the host (||example.com/...) cannot match if
+    their literal prefix does not fit the head, so they are left out. A Parser is
+    dropped if none of its rules are left, or replaced by a Parser of the rest, shared
+    by the heads leaving out the same rules, e.g. the |http: rules of the 'http'
+    shortcut on every https url.
+
+    Heads are kept in an LRU cache of at most maxsize entries, and reduced Parsers in
+    one of at most REDUCED_PARSER_CACHE_SIZE; heads only refer to their reduced Parsers
+    by the rules they keep, so a reduced Parser evicted is built again the next time
+    one of them needs it. Urls without an authority (data:, about:, ...) are not cached,
+    and the candidates of a head are only worked out once it comes back, since
+    reducing them for a head seen once costs more than it saves.
+    """
+
+    def __init__(self, maxsize=HOST_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        # head -> HostEntry
+        self.heads = LRUCache(self.maxsize)
+        # (parser, indices of the rules kept) -> Parser of those rules
+        self.reduced_parsers = LRUCache(REDUCED_PARSER_CACHE_SIZE)
+        # parser -> the anchors of its anchored rules, with the indices of the rules having each
+        self.anchored_rules = {}
+        self.pruned_parsers = 0
+        self.pruned_rules = 0
+
+    def get_head(self, url):
+        """Returns the HostEntry of url's head, or None if url has no authority or its
+        head was not seen before, in which case it is added"""
+        match = URL_HEAD_RE.match(url)
+        if not match.group(2):
+            return None
+        head = match.group(0)
+        entry = self.heads.get(head)
+        if entry is None:
+            self.heads.put(head, HostEntry(head))
+        return entry
+
+    def get_host_anchors(self, entry):
+        # with an authority, the host anchors of a url end within its head
+        return get_host_anchors(entry.head)
+
+    def get_candidates(self, url, head_candidates, iter_matches, max_shortcut_size):
+        """Returns the (tag, parser) candidates of url, with those found in its head taken
+        from the cache and without the rules which cannot match on its host, or None if
+        url has no authority or its head is new.
+
+        head_candidates(entry) yields the (tag, parser) pairs found in the head of entry
+        alone, and iter_matches(url, start) yields (end, (tag, parser)) for the shortcuts
+        of url from start, as AhoCorasick.iter_matches does.
+        """
+        entry = self.get_head(url)
+        if entry is None:
+            return None
+        if entry.candidates is None:
+            entry.starts = get_host_anchor_starts(entry.head, URL_HEAD_RE.match(entry.head))
+            self.set_head_candidates(entry, head_candidates(entry))
+        candidates = self.get_head_candidates(entry)
+        # the shortcuts ending after the head may start within it
+        head_length = len(entry.head)
+        start = max(0, head_length - max_shortcut_size + 1)
+        prune = self.prune
+        for end, (tag, parser) in iter_matches(url, start):
+            if end >= head_length:
+                parser = prune(entry, parser)
+                if parser is not None:
+                    candidates.append((tag, parser))
+        return candidates
+
+    def set_head_candidates(self, entry, candidates):
+        """Keeps candidates, the (tag, parser) pairs found in the head of entry alone,
+        with the rules of their parsers which cannot match left out; tag is whatever
+        the parser using the cache needs to tell candidates apart, e.g. their list"""
+        entry.candidates = []
+        for tag, parser in candidates:
+            kept, num_pruned = self._get_reduction(entry, parser)
+            entry.num_pruned_rules += num_pruned
+            if kept == ():
+                entry.num_pruned_parsers += 1
+            else:
+                entry.candidates.append((tag, parser, kept))
+
+    def get_head_candidates(self, entry):
+        """Returns the (tag, parser) pairs of the head candidates of a url with the head
+        of entry, counting the parsers and rules left out of them"""
+        self.pruned_parsers += entry.num_pruned_parsers
+        self.pruned_rules += entry.num_pruned_rules
+        return [(tag, parser if kept is None else self._get_reduced_parser(parser, kept))
+                for tag, parser, kept in entry.candidates]
+
+    def prune(self, entry, parser):
+        """Returns parser, or a Parser of those of its rules which may match urls with
+        the head of entry, or None if none may"""
+        kept, num_pruned = self._get_reduction(entry, parser)
+        if kept is None:
+            return parser
+        self.pruned_rules += num_pruned
+        if kept == ():
+            self.pruned_parsers += 1
+            return None
+        return self._get_reduced_parser(parser, kept)
+
+    def stats(self):
+        stats = self.heads.stats()
+        stats['reduced_parsers'] = len(self.reduced_parsers)
+        stats['pruned_parsers'] = self.pruned_parsers
+        stats['pruned_rules'] = self.pruned_rules
+        return stats
+
+    def _get_reduction(self, entry, parser):
+        reduction = entry.reduced.get(parser)
+        if reduction is None:
+            reduction = self._reduce(parser, entry.head, entry.starts)
+            if len(entry.reduced) < MAX_HEAD_REDUCTIONS:
+                entry.reduced[parser] = reduction
+        return reduction
+
+    def _reduce(self, parser, head, starts):
+        """Returns the indices of the rules of parser which may match urls with head (None
+        if all of them, () if none), and the number of rules left out"""
+        anchored_rules = self.anchored_rules.get(parser)
+        if anchored_rules is None:
+            anchored_rules = self.anchored_rules[parser] = _get_anchored_rules(parser)
+        pruned = []
+        for (label_anchored, literal), indices in anchored_rules:
+            if not _literal_fits_head(literal, head, starts if label_anchored else (0,)):
+                pruned += indices
+        if not pruned:
+            return None, 0
+        pruned = set(pruned)
+        return tuple(i for i in range(len(parser.rules)) if i not in pruned), len(pruned)
+
+    def _get_reduced_parser(self, parser, kept):
+        key = (parser, kept)
+        reduced = self.reduced_parsers.get(key)
+        if reduced is None:
+            reduced = Parser([parser.rules[i].raw_rule_text for i in kept], parser.rule_cls)
+            self.reduced_parsers.put(key, reduced)
+        return reduced
+
+
+def _get_anchored_rules(parser):
+    """Returns ((whether anchored at a label, literal prefix), rule indices) for each
+    anchor of the rules of parser anchored at the start of the url or at a label"""
+    # literal and host rules are never anchored otherwise than by their bucket
+    if not isinstance(parser, Parser):
+        return ()
+    anchored_rules = {}
+    for i, rule in enumerate(parser.rules):
+        anchor = _get_anchor(rule.rule_text)
+        if anchor is not None:
+            anchored_rules.setdefault(anchor, []).append(i)
+    return tuple(anchored_rules.items())
+
+
+def _get_anchor(rule_text):
+    """Returns whether rule_text is anchored at a label, and its literal prefix, or None
+    if it is not anchored or its prefix is empty"""
+    if rule_text.startswith('||'):
+        label_anchored, literal = True, rule_text[2:]
+    elif rule_text.startswith('|'):
+        label_anchored, literal = False, rule_text[1:]
+    else:
+        return None
+    for placeholder in '*^|':
+        literal = literal.split(placeholder, 1)[0]
+    return (label_anchored, literal) if literal else None
+
+
+def _literal_fits_head(literal, head, starts):
+    for start in starts:
+        text = head[start:]
+        if text.startswith(literal):
+            return True
+        # the url goes on after its authority with a path, a query or a fragment
+        if literal.startswith(text) and literal[len(text)] in '/?#':
+            return True
+    return False
+
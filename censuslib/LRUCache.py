@@ -0,0 +1,71 @@
+import sys
+from collections import OrderedDict
+
+class LRUCache:
+    """Mapping bounded by a number of entries and/or an estimate of its memory use,
+    evicting the least recently used entries first and counting hits, misses and
+    evictions"""
+
+    def __init__(self, maxsize=None, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None, count=True):
+        """Returns the value of key, marking it as recently used, or default. With
+        count=False the lookup is not counted, for callers whose lookups take several
+        gets to count them once with count_lookup"""
+        try:
+            value, _ = self.entries[key]
+        except KeyError:
+            if count:
+                self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        if count:
+            self.hits += 1
+        return value
+
+    def count_lookup(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.num_bytes -= self.entries.pop(key)[1]
+        size = _sizeof(key) + _sizeof(value)
+        self.entries[key] = (value, size)
+        self.num_bytes += size
+        while self.entries and ((self.maxsize is not None and len(self.entries) > self.maxsize) or
+                                (self.max_bytes is not None and self.num_bytes > self.max_bytes)):
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.num_bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.num_bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+def _sizeof(obj):
+    """Rough memory use of obj, counting the items of a tuple"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, tuple):
+        size += sum(sys.getsizeof(item) for item in obj)
+    return size
@@ -0,0 +1,45 @@
+from PublicSuffixTrie import is_ip_address
+
+
+class OrganizationIndex:
+    """Index from the domains listed in org_domains.json to the organizations listing
+    them, built once.
+
+    A domain resolves to the organizations listing it or, failing that, its closest
+    parent domain listed (ads.example.com to example.com). Where several
+    organizations list the same domain, both the first and the last of them in the
+    list are kept.
+    """
+
+    def __init__(self, org_domains):
+        # domain -> (first org listing it, last org listing it)
+        self.orgs = {}
+        for org in org_domains:
+            try:
+                domains = org[u'domains']
+            except KeyError:
+                continue
+            for domain in domains:
+                first = self.orgs.get(domain, (org,))[0]
+                self.orgs[domain] = (first, org)
+
+    def __len__(self):
+        return len(self.orgs)
+
+    def lookup(self, domain):
+        """Returns (first, last) of the organizations listing domain or its closest
+        listed parent domain, or None
+
+        >>> index = OrganizationIndex([{'organization': 'Example', 'domains': ['example.com']}])
+        >>> index.lookup('ads.example.com')[1]['organization'], index.lookup('example.org')
+        ('Example', None)
+        """
+        orgs = self.orgs.get(domain)
+        if orgs is not None or not domain or is_ip_address(domain):
+            return orgs
+        labels = domain.split('.')
+        for i in range(1, len(labels)):
+            orgs = self.orgs.get('.'.join(labels[i:]))
+            if orgs is not None:
+                return orgs
+        return None
@@ -0,0 +1,173 @@
+import re
+from RegexParser import SingleRuleParser, split_data
+from RequestContext import get_request_context
+
+# characters matched by the ^ separator placeholder of a rule
+SEPARATOR_RE = re.compile(r'[^\w\d_\-.%]')
+# the scheme and the authority of a url, as in SingleRuleParser.rule_to_regex
+URL_HEAD_RE = re.compile(r'([^:/?#]+:)?(//[^/?#]*)?')
+
+
+class PlainRuleParser:
+    """Rules whose url part can be decided without running their regex.
+
+    Offers the checking interface of RegexParser.Parser, so BlockListParser can mix
+    both kinds of candidates; subclasses define how a rule's url part is tested.
+    """
+
+    def __init__(self, rules, rule_cls=SingleRuleParser):
+        self.rule_cls = rule_cls
+        self.rules = []
+        for r in rules:
+            self.rules.append(rule_cls(r))
+        self.blacklist, self.whitelist = split_data(self.rules, lambda r: not r.is_exception)
+
+    def check(self, url, options=None, signature=None):
+        options = get_request_context(options)
+        if self.is_whitelisted(url, options):
+            return 1
+        if self.is_blacklisted(url, options):
+            return -1
+        return 0
+
+    def check_with_items(self, url, options=None, signature=None):
+        options = get_request_context(options)
+        if self.is_whitelisted(url, options):
+            return 1, []
+        blacklisted, items = self.is_blacklisted_with_items(url, options)
+        if blacklisted:
+            return -1, items
+        return 0, []
+
+    def is_whitelisted(self, url, options=None, signature=None):
+        context = get_request_context(options)
+        return any(self._rule_matches(rule, url, context) for rule in self.whitelist)
+
+    def is_blacklisted(self, url, options=None, signature=None):
+        context = get_request_context(options)
+        return any(self._rule_matches(rule, url, context) for rule in self.blacklist)
+
+    def is_blacklisted_with_items(self, url, options=None, signature=None):
+        context = get_request_context(options)
+        items = [rule.get_rule() for rule in self.blacklist if self._rule_matches(rule, url, context)]
+        return bool(items), items
+
+    def is_whitelisted_with_items(self, url, options=None, signature=None):
+        context = get_request_context(options)
+        items = [rule.get_rule() for rule in self.whitelist if self._rule_matches(rule, url, context)]
+        return bool(items), items
+
+    def whitelisted_many(self, urls, options_list, signatures=None):
+        return [self.is_whitelisted(url, options) for url, options in zip(urls, options_list)]
+
+    def blacklisted_many(self, urls, options_list, signatures=None):
+        return [self.is_blacklisted(url, options) for url, options in zip(urls, options_list)]
+
+    def is_domain_sensitive(self, options=None, signature=None):
+        options = get_request_context(options)
+        return any('domain' in rule.options and rule.matching_supported(options)
+                   and rule.match_binary_options(options) for rule in self.rules)
+
+    def _rule_matches(self, rule, url, context):
+        return rule.match_context(context) and self._url_matches(rule, url)
+
+    def _url_matches(self, rule, url):
+        raise NotImplementedError
+
+    def print_rules(self):
+        for rule in self.blacklist:
+            print("1:", rule.get_rule())
+        for rule in self.whitelist:
+            print("2:", rule.get_rule())
+
+
+class LiteralParser(PlainRuleParser):
+    """Rules made of a plain substring, without any *, ^ or | placeholder"""
+
+    @classmethod
+    def is_literal_rule(cls, line):
+        """Whether the rule on line is a plain substring which SingleRuleParser would
+        match case-sensitively; rules with upper case letters are left to the regex
+        tier, since the shortcuts they are found by are lower case"""
+        rule_text = get_network_rule_text(line)
+        return bool(rule_text) and not any(ch in rule_text for ch in '*^|') and rule_text == rule_text.lower()
+
+    def _url_matches(self, rule, url):
+        return rule.rule_text in url
+
+
+class HostParser(PlainRuleParser):
+    """||domain^ rules of a single domain, found by looking up the url's host anchors"""
+
+    HOST_RULE_RE = re.compile(r'^\|\|([A-Za-z0-9.\-]+)\^$')
+
+    @classmethod
+    def get_host_rule_domain(cls, line):
+        """Returns the domain of a ||domain^ rule, or None for any other rule"""
+        rule_text = get_network_rule_text(line)
+        match = cls.HOST_RULE_RE.match(rule_text) if rule_text else None
+        return match.group(1) if match else None
+
+    def _url_matches(self, rule, url):
+        # the url was looked up by one of its host anchors, which equals the domain
+        return True
+
+
+def get_network_rule_text(line):
+    """Returns the url part of a network rule as SingleRuleParser splits it, or None
+    for comments and element hiding rules"""
+    line = line.strip()
+    if line.startswith(('!', '[Adblock')) or '##' in line or '#@#' in line:
+        return None
+    if line.startswith('@@'):
+        line = line[2:]
+    return line.split('$', 1)[0]
+
+
+def get_host_anchors(url):
+    """Returns the substrings of url a ||domain^ rule must equal to match it.
+
+    The regex built by SingleRuleParser.rule_to_regex for ||domain^ lets the domain
+    start at the beginning of the url, right after its scheme, or at the beginning
+    of its authority or of any label of it, and requires a separator (or the end of
+    the url) right after the domain, which only holds domain characters. So each such
+    start yields exactly one candidate: the text up to the next separator.
+
+    >>> get_host_anchors('https://www.example.com:8080/ads?x=1')
+    ['https', 'www.example.com', 'example.com', 'com']
+    """
+    starts = get_host_anchor_starts(url, URL_HEAD_RE.match(url))
+    anchors = []
+    end = -1
+    for start in starts:
+        # starts are increasing, so the separator found for an earlier start is
+        # also the first one after any later start preceding it
+        if start > end:
+            separator = SEPARATOR_RE.search(url, start)
+            end = separator.start() if separator else len(url)
+        if end > start:
+            anchors.append(url[start:end])
+    return anchors
+
+
+def get_host_anchor_starts(url, head):
+    """Returns the positions of url a ||domain rule may start matching at, head being
+    URL_HEAD_RE's match of url: its beginning, the end of its scheme, and the
+    beginning of its authority and of every label of it
+
+    >>> url = 'https://www.example.com/'
+    >>> get_host_anchor_starts(url, URL_HEAD_RE.match(url))
+    [0, 6, 8, 12, 20]
+    """
+    starts = [0]
+    if head.group(1):
+        starts.append(head.end(1))
+    if head.group(2):
+        authority_start = head.start(2) + 2
+        authority_end = head.end(2)
+        starts.append(authority_start)
+        dot = url.find('.', authority_start, authority_end)
+        while dot != -1:
+            starts.append(dot + 1)
+            dot = url.find('.', dot + 1, authority_end)
+    return starts
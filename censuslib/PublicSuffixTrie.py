@@ -0,0 +1,103 @@
+import re
+from ipaddress import ip_address
+from LRUCache import LRUCache
+
+HOSTNAME_CACHE_SIZE = 100000
+
+# a dotted IPv4 address, as ipaddress.ip_address accepts it (no leading zeros)
+IPV4_RE = re.compile(r'(?:(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}'
+                     r'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\Z')
+
+
+class PublicSuffixTrie:
+    """The rules of a public suffix list (public_suffix_list.dat) in a trie over
+    their labels in reverse order (com -> co -> *), resolving hostnames to their
+    registrable domain as publicsuffix.PublicSuffixList.get_public_suffix does.
+
+    As in that module, the labels leading to a rule (e.g. kawasaki.jp for
+    *.kawasaki.jp) count as public suffixes too. Resolved hostnames are kept in an
+    LRU cache of at most cache_size entries.
+    """
+
+    def __init__(self, input_file, cache_size=HOSTNAME_CACHE_SIZE):
+        """input_file is a file object or another iterable of the lines of the list"""
+        # a node is [is an exception rule, children]
+        self.root = [False, {}]
+        for line in input_file:
+            line = line.strip()
+            if line.startswith('//') or not line:
+                continue
+            self.add(line.split()[0].lstrip('.'))
+        self.cache = LRUCache(cache_size)
+
+    def add(self, rule):
+        exception = rule.startswith('!')
+        if exception:
+            rule = rule[1:]
+        node = self.root
+        for label in reversed(rule.split('.')):
+            child = node[1].get(label)
+            if child is None:
+                child = node[1][label] = [False, {}]
+            node = child
+        node[0] = exception
+
+    def get_public_suffix(self, domain):
+        """get_public_suffix("www.example.com") -> "example.com"
+
+        >>> psl = PublicSuffixTrie(['com', 'uk', 'co.uk', '*.kawasaki.jp', '!city.kawasaki.jp'])
+        >>> psl.get_public_suffix('www.example.co.uk'), psl.get_public_suffix('co.uk')
+        ('example.co.uk', 'co.uk')
+        >>> psl.get_public_suffix('a.b.kawasaki.jp'), psl.get_public_suffix('a.city.kawasaki.jp')
+        ('a.b.kawasaki.jp', 'city.kawasaki.jp')
+        """
+        suffix = self.cache.get(domain)
+        if suffix is None:
+            suffix = self._lookup(domain)
+            self.cache.put(domain, suffix)
+        return suffix
+
+    def _lookup(self, domain):
+        parts = domain.lower().strip('.').split('.')
+        # the registrable domain has one label more than the longest public suffix,
+        # unless an exception rule makes that one registrable; at each depth, the
+        # node of the exact label overrides the * one
+        num_labels = 1
+        nodes = [self.root]
+        for depth in range(1, len(parts)):
+            label = parts[-depth]
+            next_nodes = []
+            for node in nodes:
+                children = node[1]
+                if children:
+                    child = children.get('*')
+                    if child is not None:
+                        next_nodes.append(child)
+                    child = children.get(label)
+                    if child is not None:
+                        next_nodes.append(child)
+            if not next_nodes:
+                break
+            if not next_nodes[-1][0]:
+                num_labels = depth + 1
+            nodes = next_nodes
+        return '.'.join(parts[-num_labels:])
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def is_ip_address(hostname):
+    """Whether hostname is an IPv4 or IPv6 address, as ipaddress.ip_address tells,
+    checking IPv4 addresses without raising
+
+    >>> is_ip_address('10.0.0.1'), is_ip_address('::1'), is_ip_address('10.0.0.256')
+    (True, True, False)
+    """
+    if ':' not in hostname:
+        return IPV4_RE.match(hostname) is not None
+    try:
+        ip_address(hostname)
+        return True
+    except ValueError:
+        return False
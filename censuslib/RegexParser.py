@@ -1,7 +1,59 @@
 import re
+import time
 from collections import defaultdict
+from DomainTrie import DomainTrie
+from RequestContext import get_option_masks, get_request_context
+from RuleProfiler import RuleProfiler
+from RuleTable import RuleTable
+
+# set by enable_profiling; while set, every rule is timed, and the rules a RuleGroup
+# otherwise searches with its combined regex are searched one by one
+_profiler = None
+# the number of rules from which a RuleGroup searches its rules anchored at the start of
+# the url with one combined regex
+COMBINED_REGEX_MIN_RULES = 50
+# backreferences and named groups, which would not survive being joined with other regexes
+_UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P')
+# regex -> compiled pattern, shared by identical rules of every list and Parser
+_compiled_regexes = {}
+# the texts of every rule loaded in the process, indexed by rule id
+_rule_table = RuleTable()
+# options text (None for rules without options) -> RuleOptions, shared by the rules having them
+_rule_options = {}
+
+
+class RuleOptions:
+    """The parsed options of a rule, shared by every rule with the same options text"""
+
+    __slots__ = ('text', 'raw_options', 'options', 'keys', 'signature', 'option_mask', 'value_mask')
+
+    def __init__(self, text, raw_options, options):
+        self.text = text
+        self.raw_options = raw_options
+        self.options = options
+        self.keys = frozenset(options.keys()) - set(['match-case'])
+        # hashable form of the options, equal for rules whose options only differ in order
+        self.signature = tuple(sorted(
+            (optname, tuple(sorted(value.items())) if optname == 'domain' else value)
+            for optname, value in options.items()))
+        # the options every request must be given, as in RequestContext, and their values
+        self.option_mask, self.value_mask = get_option_masks(
+            item for item in options.items() if item[0] not in ('domain', 'match-case'))
+
+    def __getstate__(self):
+        # the masks are recomputed, the bits of some options being given per process
+        return self.text, self.raw_options, self.options
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
 
 class SingleRuleParser:
+    """One rule of a list. Its texts are kept in the process's RuleTable under its rule
+    id and its parsed options are shared with the rules having the same ones, so a rule
+    only holds its flags and references to those."""
+
+    __slots__ = ('rule_id', 'rule_options', 'is_comment', 'is_html_rule', 'is_exception', 'regex_re')
 
     BINARY_OPTIONS = [
         "script",
@@ -28,7 +80,7 @@ class SingleRuleParser:
     OPTIONS_SPLIT_RE = re.compile(OPTIONS_SPLIT_PAT)
 
     def __init__(self, rule_text):
-        self.raw_rule_text = rule_text
+        raw_rule_text = rule_text
         self.regex_re = None
 
         rule_text = rule_text.strip()
@@ -43,47 +95,92 @@ class SingleRuleParser:
 
         if not self.is_comment and '$' in rule_text:
             rule_text, options_text = rule_text.split('$', 1)
-            self.raw_options = self._split_options(options_text)
-            self.options = dict(self._parse_option(opt) for opt in self.raw_options)
         else:
-            self.raw_options = []
-            self.options = {}
-        self._options_keys = frozenset(self.options.keys()) - set(['match-case'])
-
-        self.rule_text = rule_text
+            options_text = None
+        self.rule_options = self._get_rule_options(options_text)
 
         if self.is_comment or self.is_html_rule:
             # TODO: add support for HTML rules.
             # We should split the rule into URL and HTML parts,
             # convert URL part to a regex and parse the HTML part.
-            self.regex = ''
+            regex = ''
         elif not rule_text:
             self.is_comment = True
-            self.regex = ''
+            regex = ''
         else:
-            self.regex = self.rule_to_regex(rule_text)
+            regex = None
 
-    def match_url(self, url, options=None):
-        options = options or {}
-        for optname in self.options:
-            if optname == 'match-case':  # TODO
-                continue
+        rule_id = _rule_table.get_id(raw_rule_text)
+        if rule_id is None:
+            if regex is None:
+                regex = self.rule_to_regex(rule_text)
+            rule_id = _rule_table.add(raw_rule_text, rule_text, regex)
+        self.rule_id = rule_id
 
-            if optname not in options:
-                raise ValueError("Rule requires option %s" % optname)
+    @property
+    def raw_rule_text(self):
+        return _rule_table.raw_texts[self.rule_id]
 
-            if optname == 'domain':
-                if not self._domain_matches(options['domain']):
-                    return False
-                continue
+    @property
+    def rule_text(self):
+        return _rule_table.rule_texts[self.rule_id]
 
-            if options[optname] != self.options[optname]:
-                return False
+    @property
+    def regex(self):
+        return _rule_table.regexes[self.rule_id]
+
+    @property
+    def raw_options(self):
+        return self.rule_options.raw_options
+
+    @property
+    def options(self):
+        return self.rule_options.options
 
+    def match_url(self, url, options=None):
+        if not self.match_options(options):
+            return False
         return self._url_matches(url)
 
+    def match_options(self, options=None):
+        """options is a RequestContext or an options dict"""
+        context = get_request_context(options)
+        if not self.match_binary_options(context):
+            return False
+
+        if 'domain' in self.rule_options.options:
+            if context.domain is None:
+                raise ValueError("Rule requires option domain")
+            return self._domain_matches(context.domain)
+
+        return True
+
+    def match_binary_options(self, options=None):
+        """Checks every option except $domain, which depends on the first party"""
+        context = get_request_context(options)
+        rule_options = self.rule_options
+        # TODO: match-case
+        if rule_options.option_mask & ~context.option_mask:
+            missing = [optname for optname in rule_options.keys if optname != 'domain'
+                       and optname not in context.get_options()]
+            raise ValueError("Rule requires option %s" % missing[0])
+        return not (rule_options.value_mask ^ context.value_mask) & rule_options.option_mask
+
+    def match_context(self, context):
+        """Whether the rule applies to a request given its RequestContext, that is whether
+        matching is supported with its options and they match, without raising"""
+        if self.is_comment or self.is_html_rule:
+            return False
+        rule_options = self.rule_options
+        option_mask = rule_options.option_mask
+        if option_mask & ~context.option_mask or (rule_options.value_mask ^ context.value_mask) & option_mask:
+            return False
+        if 'domain' in rule_options.options:
+            return context.domain is not None and self._domain_matches(context.domain)
+        return True
+
     def _domain_matches(self, domain):
-        domain_rules = self.options['domain']
+        domain_rules = self.rule_options.options['domain']
         for domain in _domain_variants(domain):
             if domain in domain_rules:
                 return domain_rules[domain]
@@ -91,8 +188,13 @@ class SingleRuleParser:
 
     def _url_matches(self, url):
         if self.regex_re is None:
-            self.regex_re = re.compile(self.regex)
-        return bool(self.regex_re.search(url))
+            self.regex_re = compile_regex(self.regex)
+        if _profiler is None:
+            return bool(self.regex_re.search(url))
+        start = time.perf_counter()
+        matched = bool(self.regex_re.search(url))
+        _profiler.record(self.raw_rule_text, matched, time.perf_counter() - start)
+        return matched
 
     def matching_supported(self, options=None):
         if self.is_comment:
@@ -101,11 +203,14 @@ class SingleRuleParser:
         if self.is_html_rule:  # HTML rules are not supported yet
             return False
 
-        options = options or {}
-        keys = set(options.keys())
-        if not keys.issuperset(self._options_keys):
-            # some of the required options are not given
-            return False
+        rule_options = self.rule_options
+        if rule_options.keys:
+            context = get_request_context(options)
+            if rule_options.option_mask & ~context.option_mask:
+                # some of the required options are not given
+                return False
+            if 'domain' in rule_options.keys and context.domain is None:
+                return False
 
         return True
 
@@ -116,7 +221,23 @@ class SingleRuleParser:
         return self.is_comment
 
     def get_keys(self):
-        return self._options_keys
+        return self.rule_options.keys
+
+    def get_signature(self):
+        """Hashable form of the options, shared by rules with identical options"""
+        return self.rule_options.signature
+
+    @classmethod
+    def _get_rule_options(cls, options_text):
+        rule_options = _rule_options.get(options_text)
+        if rule_options is None:
+            if options_text is None:
+                raw_options, options = [], {}
+            else:
+                raw_options = cls._split_options(options_text)
+                options = dict(cls._parse_option(opt) for opt in raw_options)
+            rule_options = _rule_options[options_text] = RuleOptions(options_text, raw_options, options)
+        return rule_options
 
     @classmethod
     def _split_options(cls, options_text):
@@ -139,11 +260,33 @@ class SingleRuleParser:
         return cls._parse_option_negation(text)
 
     @classmethod
-    def rule_to_regex(cls, rule):
+    def simplify_rule(cls, rule):
+        """Drops the wildcards of rule which cannot change whether its regex is found in
+        a url: repeated *, and a * starting or ending the rule
+
+        >>> SingleRuleParser.simplify_rule('*/ads/**banner*')
+        '/ads/*banner'
+        """
+        rule = re.sub(r'\*{2,}', '*', rule)
+        if rule.startswith('|*') and not rule.startswith('||'):
+            # ^.* matches wherever .* does
+            rule = rule[1:]
+        # the remaining rule must not turn into an anchored or empty one
+        if rule.startswith('*') and len(rule) > 1 and rule[1] != '|':
+            rule = rule[1:]
+        if rule.endswith('*') and len(rule) > 1 and rule[-2] != '|':
+            rule = rule[:-1]
+        return rule
+
+    @classmethod
+    def rule_to_regex(cls, rule, simplify=True):
         if not rule:
             raise ValueError("Invalid rule")
             # return rule
 
+        if simplify:
+            rule = cls.simplify_rule(rule)
+
         # escape special regex characters
         rule = re.sub(r"([.$+?{}()\[\]\\])", r"\\\1", rule)
 
@@ -170,92 +313,249 @@ class SingleRuleParser:
     def get_rule(self):
         return self.raw_rule_text
 
-class Parser:
+    def __getstate__(self):
+        # rule ids only hold in the process which assigned them, so the texts are pickled
+        # and interned again on loading; compiled regexes are rebuilt lazily
+        return (self.raw_rule_text, self.rule_text, self.regex, self.rule_options,
+                self.is_comment, self.is_html_rule, self.is_exception)
 
-    def __init__(self, rules, rule_cls=SingleRuleParser):
+    def __setstate__(self, state):
+        raw_rule_text, rule_text, regex, rule_options, self.is_comment, self.is_html_rule, self.is_exception = state
+        self.rule_id = _rule_table.add(raw_rule_text, rule_text, regex)
+        self.rule_options = _rule_options.setdefault(rule_options.text, rule_options)
+        self.regex_re = None
 
-        self.supported_options = rule_cls.BINARY_OPTIONS + ['domain']
-        self.rule_cls = rule_cls
-        self.rules = []
-        for r in rules:
-            self.rules.append(rule_cls(r))
+class RuleGroup:
+    """Rules sharing one option signature, whose options are checked once for the
+    whole group.
+
+    Rules are searched with their own compiled regex, for which re looks their literal
+    prefix up. In groups of COMBINED_REGEX_MIN_RULES rules or more, the rules anchored
+    at the start of the url (||domain and |prefix rules) are searched with a single
+    alternation of their regexes instead, saving a search per rule since each of them
+    only tries the start of the url; the others are kept out of it, as one unanchored
+    branch makes the alternation try every position of the url.
+    """
 
-        advanced_rules, basic_rules = split_data(self.rules, lambda r: r.options)
+    def __init__(self, rules):
+        self.rules = rules
+        self.representative = rules[0]
+        self.has_domain = 'domain' in self.representative.options
+        # False for rules only carrying ~domain exclusions
+        self.domain_required = self.has_domain and any(self.representative.options['domain'].values())
+        if len(rules) >= COMBINED_REGEX_MIN_RULES:
+            self.combined_rules, self.other_rules = split_data(rules, _is_combinable)
+        else:
+            self.combined_rules, self.other_rules = [], rules
+        self.combined_re = None
 
-        # TODO: what about ~rules? Should we match them earlier?
-        domain_required_rules, non_domain_rules = split_data(
-            advanced_rules,
-            lambda r: (
-                'domain' in r.options
-                and any(r.options["domain"].values())
-            )
-        )
+    def matching_supported(self, options=None):
+        return self.representative.matching_supported(options)
+
+    def match_options(self, options=None):
+        return self.representative.match_options(options)
 
-        # split rules into blacklists and whitelists
-        self.blacklist, self.whitelist = self._split_bw(basic_rules)
-        self.blacklist_with_options, self.whitelist_with_options = self._split_bw(non_domain_rules)
-        self.blacklist_require_domain, self.whitelist_require_domain = self._split_bw_domain(domain_required_rules)
+    def match_binary_options(self, options=None):
+        return self.representative.match_binary_options(options)
 
-    def check(self, url, options=None):
-        options = options or {}
-        if self.is_whitelisted(url, options):
+    def url_matches(self, url):
+        """Checks url against the rules only, the options being already checked"""
+        if self.combined_rules:
+            if _profiler is not None:
+                # rule by rule, so that each search is attributed to its rule
+                return any(rule._url_matches(url) for rule in self.rules)
+            if self._search_combined(url):
+                return True
+        return any(rule._url_matches(url) for rule in self.other_rules)
+
+    def url_matching_rules(self, url):
+        if self.combined_rules and _profiler is None and not self._search_combined(url):
+            return [rule for rule in self.other_rules if rule._url_matches(url)]
+        return [rule for rule in self.rules if rule._url_matches(url)]
+
+    def _search_combined(self, url):
+        if self.combined_re is None:
+            self.combined_re = re.compile('|'.join('(?:%s)' % rule.regex for rule in self.combined_rules))
+        return self.combined_re.search(url) is not None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['combined_re'] = None
+        return state
+
+
+class Parser:
+
+    def __init__(self, rules, rule_cls=SingleRuleParser):
+
+        self.rule_cls = rule_cls
+        self.rules = [rule_cls(r) for r in rules]
+
+        # rules sharing an option signature have their options checked once per group;
+        # groups with a $domain option are found through a trie of their domains.
+        # The rules are only kept in self.rules and in their groups
+        basic_rules, non_domain_rules, domain_required_rules = self._split_by_options(self.rules)
+        blacklist, whitelist = self._split_bw(basic_rules + non_domain_rules + domain_required_rules)
+        self.blacklist_groups, self.blacklist_domain_groups = self._split_domain_groups(self._group_rules(blacklist))
+        self.whitelist_groups, self.whitelist_domain_groups = self._split_domain_groups(self._group_rules(whitelist))
+        self.blacklist_domain_trie = self._domain_trie(self.blacklist_domain_groups)
+        self.whitelist_domain_trie = self._domain_trie(self.whitelist_domain_groups)
+
+        # groups whose non-domain options fit a given options signature, filled on first use
+        self._supported_groups_cache = {}
+
+    def check(self, url, options=None, signature=None):
+        options = get_request_context(options)
+        if self.is_whitelisted(url, options, signature):
             return 1
-        if self.is_blacklisted(url, options):
+        if self.is_blacklisted(url, options, signature):
             return -1
         return 0
 
-    def check_with_items(self, url, options=None):
-        options = options or {}
-        if self.is_whitelisted(url, options):
+    def check_with_items(self, url, options=None, signature=None):
+        options = get_request_context(options)
+        if self.is_whitelisted(url, options, signature):
             return 1, []
-        blacklisted, items = self.is_blacklisted_with_items(url, options)
+        blacklisted, items = self.is_blacklisted_with_items(url, options, signature)
         if blacklisted:
             return -1, items
         return 0, []
 
-    def is_whitelisted(self, url, options=None):
-        return self._matches(url, options, self.whitelist, self.whitelist_require_domain, self.whitelist_with_options)
-
-    def is_blacklisted(self, url, options=None):
-        return self._matches(url, options, self.blacklist, self.blacklist_require_domain, self.blacklist_with_options)
-
-    def is_blacklisted_with_items(self, url, options=None):
-        return self._matches_with_items(url, options, self.blacklist, self.blacklist_require_domain, self.blacklist_with_options)
-
-    def _matches(self, url, options, general_rules, domain_required_rules, rules_with_options):
-        rules = general_rules + rules_with_options
-        if options and 'domain' in options and domain_required_rules:
-            src_domain = options['domain']
-            for domain in _domain_variants(src_domain):
-                if domain in domain_required_rules:
-                    rules.extend(domain_required_rules[domain])
-        rules = [rule for rule in rules if rule.matching_supported(options)]
-        return any(rule.match_url(url, options) for rule in rules)
-
-    def _matches_with_items(self, url, options, general_rules, domain_required_rules, rules_with_options):
-        rules = general_rules + rules_with_options
-        if options and 'domain' in options and domain_required_rules:
-            src_domain = options['domain']
-            for domain in _domain_variants(src_domain):
-                if domain in domain_required_rules:
-                    rules.extend(domain_required_rules[domain])
-        rules = [rule for rule in rules if rule.matching_supported(options)]
-        matches = False
+    def is_whitelisted(self, url, options=None, signature=None):
+        return self._matches(url, options, signature, 'whitelist')
+
+    def is_blacklisted(self, url, options=None, signature=None):
+        return self._matches(url, options, signature, 'blacklist')
+
+    def is_blacklisted_with_items(self, url, options=None, signature=None):
+        return self._matches_with_items(url, options, signature, 'blacklist')
+
+    def is_whitelisted_with_items(self, url, options=None, signature=None):
+        return self._matches_with_items(url, options, signature, 'whitelist')
+
+    def whitelisted_many(self, urls, options_list, signatures=None):
+        """Returns, for each url with its options, whether it is whitelisted"""
+        return self._matches_many(urls, options_list, signatures, 'whitelist')
+
+    def blacklisted_many(self, urls, options_list, signatures=None):
+        """Returns, for each url with its options, whether it is blacklisted"""
+        return self._matches_many(urls, options_list, signatures, 'blacklist')
+
+    def is_domain_sensitive(self, options=None, signature=None):
+        """Whether rules with a $domain option apply to urls checked with these options,
+        that is whether the verdict may depend on the first-party domain"""
+        if signature is None:
+            signature = options_signature(options)
+        options = get_request_context(options)
+        return bool(self._supported_groups(signature, options, 'whitelist')[1] or
+                    self._supported_groups(signature, options, 'blacklist')[1])
+
+    def _supported_groups(self, signature, options, list_name):
+        """Returns the groups of list_name whose required options are given and whose
+        binary options match: the groups without a $domain option, the set of groups
+        with one, and those of the latter that only have ~domain exclusions.
+
+        This only depends on the options signature, so it is computed once per signature
+        and the rules requiring other options ($script, $image, ...) are not looked at again.
+        """
+        cache_key = (signature, list_name)
+        supported = self._supported_groups_cache.get(cache_key)
+        if supported is None:
+            groups = getattr(self, list_name + '_groups')
+            domain_groups = [group for group in getattr(self, list_name + '_domain_groups')
+                             if group.matching_supported(options) and group.match_binary_options(options)]
+            supported = ([group for group in groups
+                          if group.matching_supported(options) and group.match_binary_options(options)],
+                         frozenset(domain_groups),
+                         [group for group in domain_groups if not group.domain_required])
+            self._supported_groups_cache[cache_key] = supported
+        return supported
+
+    def _applicable_groups(self, options, signature, list_name):
+        context = get_request_context(options)
+        if signature is None:
+            signature = context.signature
+        applicable, domain_groups, exclusion_groups = self._supported_groups(signature, context, list_name)
+        if domain_groups:
+            # a group applies if the most specific of the first party's domains it lists is
+            # included, or if it lists none of them and only has ~domain exclusions
+            matched = getattr(self, list_name + '_domain_trie').lookup(context.domain, min_labels=2)
+            applicable = applicable + [group for group, included in matched.items()
+                                       if included and group in domain_groups]
+            applicable += [group for group in exclusion_groups if group not in matched]
+        return applicable
+
+    def _matches(self, url, options, signature, list_name):
+        groups = self._applicable_groups(options, signature, list_name)
+        return any(group.url_matches(url) for group in groups)
+
+    def _matches_with_items(self, url, options, signature, list_name):
+        groups = self._applicable_groups(options, signature, list_name)
         items = []
-        for rule in rules:
-            if rule.match_url(url, options):
-                matches = True
+        for group in groups:
+            for rule in group.url_matching_rules(url):
                 items.append(rule.get_rule())
-        return matches, items
+        return bool(items), items
+
+    def _matches_many(self, urls, options_list, signatures, list_name):
+        # run each group over every url it applies to, instead of url by url
+        if signatures is None:
+            signatures = [None] * len(urls)
+        urls_by_group = defaultdict(list)
+        for i, (options, signature) in enumerate(zip(options_list, signatures)):
+            for group in self._applicable_groups(options, signature, list_name):
+                urls_by_group[group].append(i)
+        matches = [False] * len(urls)
+        for group, indices in urls_by_group.items():
+            for i in indices:
+                if not matches[i] and group.url_matches(urls[i]):
+                    matches[i] = True
+        return matches
+
+    @classmethod
+    def _group_rules(cls, rules):
+        groups = defaultdict(list)
+        for rule in rules:
+            if rule.is_comment or rule.is_html_rule:
+                continue
+            groups[rule.get_signature()].append(rule)
+        return [RuleGroup(group_rules) for group_rules in groups.values()]
+
+    @classmethod
+    def _split_domain_groups(cls, groups):
+        return split_data(groups, lambda group: not group.has_domain)
+
+    @classmethod
+    def _domain_trie(cls, domain_groups):
+        if not domain_groups:
+            return None
+        return DomainTrie((domain, group, included)
+                          for group in domain_groups
+                          for domain, included in group.representative.options['domain'].items())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_supported_groups_cache'] = {}
+        return state
 
     @classmethod
     def _split_bw(cls, rules):
         return split_data(rules, lambda r: not r.is_exception)
 
     @classmethod
-    def _split_bw_domain(cls, rules):
-        blacklist, whitelist = cls._split_bw(rules)
-        return cls._domain_index(blacklist), cls._domain_index(whitelist)
+    def _split_by_options(cls, rules):
+        """Splits rules into those without options, those with options but no $domain
+        to apply on, and those with one"""
+        advanced_rules, basic_rules = split_data(rules, lambda r: r.options)
+        # TODO: what about ~rules? Should we match them earlier?
+        domain_required_rules, non_domain_rules = split_data(
+            advanced_rules,
+            lambda r: (
+                'domain' in r.options
+                and any(r.options["domain"].values())
+            )
+        )
+        return basic_rules, non_domain_rules, domain_required_rules
 
     @classmethod
     def _domain_index(cls, rules):
@@ -268,22 +568,81 @@ class Parser:
         return dict(result)
 
     def print_rules(self):
-        for rule in self.blacklist:
+        basic_rules, non_domain_rules, domain_required_rules = self._split_by_options(self.rules)
+        blacklist, whitelist = self._split_bw(basic_rules)
+        blacklist_with_options, whitelist_with_options = self._split_bw(non_domain_rules)
+        blacklist_require_domain, whitelist_require_domain = self._split_bw(domain_required_rules)
+        for rule in blacklist:
             print("1:", rule.get_rule())
-        for rule in self.whitelist:
+        for rule in whitelist:
             print("2:",rule.get_rule())
-        for domain in self.blacklist_require_domain:
-            for rule in self.blacklist_require_domain[domain]:
-                print("3:", domain, ":", rule.get_rule())
-        for domain in self.whitelist_require_domain:
-            for rule in self.whitelist_require_domain[domain]:
-                print("4:", domain, ":", rule.get_rule())
-        for rule in self.blacklist_with_options:
+        for prefix, rules in (("3:", blacklist_require_domain), ("4:", whitelist_require_domain)):
+            domain_index = self._domain_index(rules)
+            for domain in domain_index:
+                for rule in domain_index[domain]:
+                    print(prefix, domain, ":", rule.get_rule())
+        for rule in blacklist_with_options:
             print("5:", rule.get_rule())
-        for rule in self.whitelist_with_options:
+        for rule in whitelist_with_options:
             print("6:", rule.get_rule())
 
 
+def compile_regex(regex):
+    """Returns the compiled pattern of regex, compiling each distinct regex once per process"""
+    pattern = _compiled_regexes.get(regex)
+    if pattern is None:
+        pattern = _compiled_regexes[regex] = re.compile(regex)
+    return pattern
+
+
+def clear_rule_tables():
+    """Empties the process's RuleTable, shared rule options and compiled regexes.
+
+    Rules already built refer to the table by rule id, so this is only for a process
+    about to build its rules from scratch, e.g. to measure the memory of a build.
+    """
+    global _rule_table
+    _rule_table = RuleTable()
+    _rule_options.clear()
+    _compiled_regexes.clear()
+
+
+def enable_profiling():
+    """Starts recording, for every rule, how often it is evaluated and matched and its
+    total regex search time, and returns the RuleProfiler holding them.
+
+    While profiling, the rules a group searches with its combined regex are searched
+    one by one instead, so classification is slower.
+    """
+    global _profiler
+    _profiler = RuleProfiler()
+    return _profiler
+
+
+def disable_profiling():
+    """Stops profiling and returns the RuleProfiler, or None if profiling was off"""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+def options_signature(options):
+    """
+    Hashable form of the options a url is checked with, leaving out the
+    first-party domain itself: the signature of its RequestContext. Computing
+    it once per url and passing it to the Parser methods saves recomputing it
+    for every candidate Parser.
+
+    >>> options_signature({'script': True, 'domain': 'example.com'})
+    (True, 1, 1)
+    """
+    return get_request_context(options).signature
+
+
 def _domain_variants(domain):
     """
     >>> list(_domain_variants("foo.bar.example.com"))
@@ -296,6 +655,10 @@ def _domain_variants(domain):
         yield ".".join(parts[-i:])
 
 
+def _is_combinable(rule):
+    return rule.regex.startswith('^') and _UNCOMBINABLE_RE.search(rule.regex) is None
+
+
 def split_data(iterable, pred):
     """
     Split data from ``iterable`` into two lists.
@@ -0,0 +1,95 @@
+# the options a request may be checked with, besides $domain, each given one bit of
+# the masks of a RequestContext. Options only seen in rules ($popup, ...) are given
+# the next free bits, so masks only hold in the process computing them
+OPTION_BITS = {}
+
+def get_option_bit(optname):
+    bit = OPTION_BITS.get(optname)
+    if bit is None:
+        bit = OPTION_BITS[optname] = 1 << len(OPTION_BITS)
+    return bit
+
+def get_option_masks(options):
+    """Returns the mask of the options of the (option, value) pairs options, and the
+    mask of those whose value is true. Options whose value is None are left out, as
+    neither $option nor $~option rules match them.
+
+    >>> get_option_masks([('script', True), ('image', False), ('third-party', None)])
+    (3, 1)
+    """
+    option_mask = value_mask = 0
+    for optname, value in options:
+        if value is None:
+            continue
+        bit = get_option_bit(optname)
+        option_mask |= bit
+        if value:
+            value_mask |= bit
+    return option_mask, value_mask
+
+for _optname in ('script', 'image', 'third-party', 'stylesheet', 'object', 'xmlhttprequest',
+                 'object-subrequest', 'subdocument', 'document', 'elemhide', 'other',
+                 'background', 'xbl', 'ping', 'dtd', 'media', 'collapse', 'donottrack'):
+    get_option_bit(_optname)
+
+
+class RequestContext:
+    """A request as the blocklists check it: the first-party domain it was made from
+    and the options it is checked with, computed once.
+
+    The options are held as two bitmasks, one bit per option: option_mask has the
+    bits of the options given (e.g. whether the request is a script is known) and
+    value_mask those which are true, so that rules check theirs with bit operations.
+    signature is the hashable form of those, shared by the requests every rule
+    without a $domain option gives the same verdict for given the same url.
+    """
+
+    __slots__ = ('domain', 'option_mask', 'value_mask', 'signature')
+
+    def __init__(self, domain=None, third_party=None, types=None):
+        """types maps the resource types of the request (script, image, ...) to whether
+        it is of that type, or None if it is not known; so does third_party"""
+        self.domain = domain
+        options = list(types.items()) if types else []
+        options.append(('third-party', third_party))
+        self._set_masks(*get_option_masks(options))
+
+    @classmethod
+    def from_options(cls, options):
+        """Returns the RequestContext of an options dict, e.g. {'script': True, 'domain': 'example.com'}"""
+        context = cls.__new__(cls)
+        context.domain = options.get('domain')
+        context._set_masks(*get_option_masks(item for item in options.items() if item[0] != 'domain'))
+        return context
+
+    def _set_masks(self, option_mask, value_mask):
+        self.option_mask = option_mask
+        self.value_mask = value_mask
+        self.signature = (self.domain is not None, option_mask, value_mask)
+
+    def get_options(self):
+        """Returns the options dict of the request"""
+        options = dict((optname, bool(self.value_mask & bit))
+                       for optname, bit in OPTION_BITS.items() if self.option_mask & bit)
+        if self.domain is not None:
+            options['domain'] = self.domain
+        return options
+
+    def __repr__(self):
+        return 'RequestContext(%r)' % self.get_options()
+
+    def __reduce__(self):
+        # the bits of options first seen in rules may differ in another process
+        return RequestContext.from_options, (self.get_options(),)
+
+
+# the context of requests checked without options
+_EMPTY_CONTEXT = RequestContext()
+
+def get_request_context(options=None):
+    """Returns options if it is a RequestContext, else the RequestContext of the options dict"""
+    if isinstance(options, RequestContext):
+        return options
+    if not options:
+        return _EMPTY_CONTEXT
+    return RequestContext.from_options(options)
@@ -0,0 +1,166 @@
+import time
+from collections import defaultdict
+from RegexParser import Parser, SingleRuleParser
+from RequestContext import get_request_context
+
+class ResidueParser:
+    """The rules no shortcut was found for, which are checked against every url.
+
+    They are split by how they can still be indexed: rules anchored at the start of
+    the url (|prefix...) are only run on urls starting with their literal prefix,
+    element hiding rules and comments are dropped since they never match a url, and
+    the other rules are kept in one Parser, which only runs the groups whose options
+    and $domain fit, searching each rule with its own regex except for the rules
+    anchored at the start of the url of large groups, which share a combined one
+    (see RegexParser.RuleGroup).
+
+    Offers the checking interface of RegexParser.Parser, and counts the urls checked
+    against the residue and the time spent on them.
+    """
+
+    def __init__(self, rules, rule_cls=SingleRuleParser):
+        self.rule_cls = rule_cls
+        self.rules = []
+        for r in rules:
+            self.rules.append(rule_cls(r))
+        prefix_lines = defaultdict(list)
+        other_lines = []
+        self.num_dropped = 0
+        for rule in self.rules:
+            if rule.is_comment or rule.is_html_rule:
+                self.num_dropped += 1
+                continue
+            prefix = _get_anchored_prefix(rule.rule_text)
+            if prefix:
+                prefix_lines[prefix].append(rule.raw_rule_text)
+            else:
+                other_lines.append(rule.raw_rule_text)
+        # first character of the prefix -> [(prefix, Parser)]
+        self.prefix_parsers = defaultdict(list)
+        for prefix, lines in sorted(prefix_lines.items()):
+            self.prefix_parsers[prefix[0]].append((prefix, Parser(lines, rule_cls)))
+        self.prefix_parsers = dict(self.prefix_parsers)
+        self.parser = Parser(other_lines, rule_cls) if other_lines else None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_urls = 0
+        self.seconds = 0.0
+
+    def get_stats(self):
+        """Returns the number of urls checked against the residue, the time spent on them,
+        and how many of its rules are anchored, unindexed or dropped"""
+        num_anchored = sum(len(parser.rules) for parsers in self.prefix_parsers.values()
+                           for _, parser in parsers)
+        return {'urls': self.num_urls,
+                'seconds': self.seconds,
+                'anchored_rules': num_anchored,
+                'unindexed_rules': len(self.parser.rules) if self.parser else 0,
+                'dropped_rules': self.num_dropped}
+
+    def check(self, url, options=None, signature=None):
+        options = get_request_context(options)
+        if self.is_whitelisted(url, options, signature):
+            return 1
+        if self._matches(url, options, signature, 'is_blacklisted', count=False):
+            return -1
+        return 0
+
+    def check_with_items(self, url, options=None, signature=None):
+        options = get_request_context(options)
+        if self.is_whitelisted(url, options, signature):
+            return 1, []
+        blacklisted, items = self.is_blacklisted_with_items(url, options, signature)
+        if blacklisted:
+            return -1, items
+        return 0, []
+
+    def is_whitelisted(self, url, options=None, signature=None):
+        return self._matches(url, options, signature, 'is_whitelisted')
+
+    def is_blacklisted(self, url, options=None, signature=None):
+        return self._matches(url, options, signature, 'is_blacklisted')
+
+    def is_blacklisted_with_items(self, url, options=None, signature=None):
+        return self._matches_with_items(url, options, signature, 'is_blacklisted_with_items')
+
+    def is_whitelisted_with_items(self, url, options=None, signature=None):
+        return self._matches_with_items(url, options, signature, 'is_whitelisted_with_items')
+
+    def whitelisted_many(self, urls, options_list, signatures=None):
+        # every url of a batch is checked against the whitelist first, so they are counted here
+        self.num_urls += len(urls)
+        return self._matches_many(urls, options_list, signatures, 'is_whitelisted')
+
+    def blacklisted_many(self, urls, options_list, signatures=None):
+        return self._matches_many(urls, options_list, signatures, 'is_blacklisted')
+
+    def is_domain_sensitive(self, options=None, signature=None):
+        return any(parser.is_domain_sensitive(options, signature) for parser in self._all_parsers())
+
+    def _get_parsers(self, url):
+        parsers = []
+        if url:
+            for prefix, parser in self.prefix_parsers.get(url[0], ()):
+                if url.startswith(prefix):
+                    parsers.append(parser)
+        if self.parser is not None:
+            parsers.append(self.parser)
+        return parsers
+
+    def _all_parsers(self):
+        parsers = [parser for prefix_parsers in self.prefix_parsers.values() for _, parser in prefix_parsers]
+        if self.parser is not None:
+            parsers.append(self.parser)
+        return parsers
+
+    def _matches(self, url, options, signature, method, count=True):
+        start = time.perf_counter()
+        matched = any(getattr(parser, method)(url, options, signature) for parser in self._get_parsers(url))
+        if count:
+            self.num_urls += 1
+        self.seconds += time.perf_counter() - start
+        return matched
+
+    def _matches_with_items(self, url, options, signature, method):
+        start = time.perf_counter()
+        items = []
+        for parser in self._get_parsers(url):
+            items += getattr(parser, method)(url, options, signature)[1]
+        self.seconds += time.perf_counter() - start
+        return bool(items), items
+
+    def _matches_many(self, urls, options_list, signatures, method):
+        if signatures is None:
+            signatures = [None] * len(urls)
+        start = time.perf_counter()
+        matches = [any(getattr(parser, method)(url, options, signature) for parser in self._get_parsers(url))
+                   for url, options, signature in zip(urls, options_list, signatures)]
+        self.seconds += time.perf_counter() - start
+        return matches
+
+    def print_rules(self):
+        for parser in self._all_parsers():
+            parser.print_rules()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['num_urls'] = 0
+        state['seconds'] = 0.0
+        return state
+
+
+def _get_anchored_prefix(rule_text):
+    """Returns the literal text a |prefix... rule requires the url to start with, or ''
+
+    >>> _get_anchored_prefix('|http://*.gif|')
+    'http://'
+    >>> _get_anchored_prefix('||example.com^')
+    ''
+    """
+    if not rule_text.startswith('|') or rule_text.startswith('||'):
+        return ''
+    prefix = rule_text[1:]
+    for placeholder in '*^|':
+        prefix = prefix.split(placeholder, 1)[0]
+    return prefix
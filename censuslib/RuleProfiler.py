@@ -0,0 +1,38 @@
+import csv
+from collections import defaultdict
+
+class RuleProfiler:
+    """Per-rule counts of evaluations and matches, and total regex search time"""
+
+    FIELDS = ['rule', 'evaluations', 'matches', 'seconds', 'mean_seconds']
+
+    def __init__(self):
+        # rule text -> [evaluations, matches, seconds]
+        self.stats = defaultdict(lambda: [0, 0, 0.0])
+
+    def record(self, rule_text, matched, seconds):
+        stats = self.stats[rule_text]
+        stats[0] += 1
+        if matched:
+            stats[1] += 1
+        stats[2] += seconds
+
+    def reset(self):
+        self.stats.clear()
+
+    def report(self, top_n=20, sort_by='seconds'):
+        """Returns the top_n rules ranked by sort_by (any of FIELDS but 'rule'), as dicts"""
+        rows = [{'rule': rule_text.strip(),
+                 'evaluations': evaluations,
+                 'matches': matches,
+                 'seconds': seconds,
+                 'mean_seconds': seconds / evaluations if evaluations else 0.0}
+                for rule_text, (evaluations, matches, seconds) in self.stats.items()]
+        rows.sort(key=lambda row: row[sort_by], reverse=True)
+        return rows[:top_n] if top_n is not None else rows
+
+    def write_csv(self, path, top_n=None, sort_by='seconds'):
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+            writer.writeheader()
+            writer.writerows(self.report(top_n, sort_by))
@@ -0,0 +1,33 @@
+class RuleTable:
+    """The texts of every rule loaded in the process, each distinct rule line stored
+    once and referred to by an integer rule id: the raw line, its url part and the
+    regex built from it.
+
+    Rules are interned by their raw line, so the same line loaded by several lists,
+    or parsed again when a bucket is rebuilt, shares one entry. Entries are never
+    dropped, so the table grows with the number of distinct lines loaded.
+    """
+
+    def __init__(self):
+        # raw rule line -> rule id
+        self.ids = {}
+        self.raw_texts = []
+        self.rule_texts = []
+        self.regexes = []
+
+    def __len__(self):
+        return len(self.raw_texts)
+
+    def get_id(self, raw_rule_text):
+        """Returns the id of the rule on raw_rule_text, or None if it was never added"""
+        return self.ids.get(raw_rule_text)
+
+    def add(self, raw_rule_text, rule_text, regex):
+        """Returns the id of the rule on raw_rule_text, adding its texts if it is new"""
+        rule_id = self.ids.get(raw_rule_text)
+        if rule_id is None:
+            rule_id = self.ids[raw_rule_text] = len(self.raw_texts)
+            self.raw_texts.append(raw_rule_text)
+            self.rule_texts.append(rule_text)
+            self.regexes.append(regex)
+        return rule_id
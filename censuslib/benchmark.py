@@ -0,0 +1,299 @@
+"""Benchmarks for the blocklist engines.
+
+Run from the repository root, e.g.:
+    python censuslib/benchmark.py easylist.txt easyprivacy.txt
+
+For each list, the suite reports the build time and peak memory of every engine,
+the latency percentiles of its calls over a fixed corpus of urls, and the number
+of urls on which the verdicts of the engines disagree (which should be 0).
+"""
+from BlockListParser import BlockListParser
+from PlainRuleParser import get_network_rule_text
+from RegexParser import Parser, SingleRuleParser, clear_rule_tables
+
+import multiprocessing
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+HOSTS = ['www.google-analytics.com', 'stats.g.doubleclick.net', 'securepubads.g.doubleclick.net',
+         'connect.facebook.net', 'www.facebook.com', 'pixel.quantserve.com', 'sb.scorecardresearch.com',
+         'cdn.taboola.com', 'ib.adnxs.com', 'ads.pubmatic.com', 'bat.bing.com', 'static.criteo.net',
+         'cdnjs.cloudflare.com', 'fonts.googleapis.com', 'ajax.googleapis.com', 'i.ytimg.com',
+         'platform.twitter.com', 's.amazon-adsystem.com', 'tags.tiqcdn.com', 'static.example-cdn.net']
+PATHS = ['/collect', '/r/collect', '/pagead/ads', '/gampad/ads', '/tr', '/pixel.gif', '/b/ss/rsid/1/H.27',
+         '/en_US/fbevents.js', '/analytics.js', '/gtm.js', '/ajax/libs/jquery/3.1.1/jquery.min.js',
+         '/css', '/vi/abc123/hqdefault.jpg', '/widgets.js', '/ut/v3/prebid', '/AdServer/AdCallAggregator',
+         '/p/action/12345.img', '/e/tag.js', '/utag/main/prod/utag.js', '/img/logo.png']
+PARAM_NAMES = ['v', 'tid', 'cid', 'uid', 'dl', 'dr', 'dt', 'ul', 'sd', 'sr', 'vp', 'je', 'ec', 'ea',
+               'el', 'ev', 'gdpr', 'correlator', 'prev_iu_szs', 'cust_params', 'url', 'ref', 'cb']
+
+
+def generate_urls(num_urls, seed=0, max_query_length=4096):
+    """Return a deterministic list of synthetic third-party URLs.
+
+    Query strings are drawn up to max_query_length characters, since multi-KB
+    query strings are common on ad-tech requests.
+    """
+    rng = random.Random(seed)
+    urls = []
+    for _ in range(num_urls):
+        url = 'http%s://%s%s' % (rng.choice(['', 's']), rng.choice(HOSTS), rng.choice(PATHS))
+        query_length = min(int(rng.expovariate(1.0 / 300)), max_query_length)
+        params = []
+        length = 0
+        while length < query_length:
+            value = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789%._-')
+                            for _ in range(rng.randint(1, 64)))
+            param = '%s=%s' % (rng.choice(PARAM_NAMES), value)
+            params.append(param)
+            length += len(param) + 1
+        if params:
+            url += '?' + '&'.join(params)
+        urls.append(url)
+    return urls
+
+
+def generate_options(urls, seed=0):
+    """Return a blocklist options dict for each url, as utils.is_tracker builds them."""
+    rng = random.Random(seed)
+    first_parties = ['cnn.com', 'nytimes.com', 'example.com', 'bbc.co.uk', 'reddit.com']
+    options_list = []
+    for url in urls:
+        is_js = url.endswith('.js') or '.js?' in url
+        options_list.append({'third-party': True,
+                             'domain': rng.choice(first_parties),
+                             'script': is_js,
+                             'image': not is_js and rng.random() < 0.3})
+    return options_list
+
+
+def generate_rule_urls(regex_files, num_urls, seed=0):
+    """Return a deterministic list of urls built from the network rules of regex_files.
+
+    Each url fills in the wildcards and separators of a rule, so most of them hit
+    some rule's shortcut and many are matched or whitelisted, unlike generate_urls
+    which mostly exercises the shortcut scan.
+    """
+    rules = []
+    for regex_file in regex_files:
+        with open(regex_file) as f:
+            rules += [rule_text for rule_text in map(get_network_rule_text, f) if rule_text]
+    rng = random.Random(seed)
+    urls = []
+    for _ in range(num_urls):
+        url = rng.choice(rules)
+        if url.startswith('||'):
+            url = 'http%s://%s%s' % (rng.choice(['', 's']), rng.choice(['', 'www.', 'cdn.']), url[2:])
+        elif url.startswith('|'):
+            url = url[1:]
+        else:
+            url = 'https://%s/%s' % (rng.choice(HOSTS), url.lstrip('/'))
+        url = url.replace('^', rng.choice(['/', '?', '&', ':8080/'])).replace('*', rng.choice(['', 'x', '/a/']))
+        url = url.replace('|', '')
+        if rng.random() < 0.3:
+            url += '?' + '&'.join('%s=%d' % (rng.choice(PARAM_NAMES), rng.randint(0, 10 ** 6))
+                                  for _ in range(rng.randint(1, 8)))
+        urls.append(url)
+    return urls
+
+
+def generate_corpus(regex_files, num_urls, seed=0):
+    """Return num_urls urls, half of generate_urls and half of generate_rule_urls in a
+    fixed shuffled order, and their options."""
+    urls = generate_urls(num_urls // 2, seed) + generate_rule_urls(regex_files, num_urls - num_urls // 2, seed)
+    random.Random(seed).shuffle(urls)
+    return urls, generate_options(urls, seed)
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(percent / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _time_each(func, urls, options_list):
+    """Returns the results of func on each url and the latency percentiles of the calls"""
+    results = []
+    latencies = []
+    for url, options in zip(urls, options_list):
+        start = time.perf_counter()
+        results.append(func(url, options))
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return results, {'calls': len(latencies),
+                     'mean_seconds': sum(latencies) / len(latencies) if latencies else 0.0,
+                     'p50_seconds': _percentile(latencies, 50),
+                     'p95_seconds': _percentile(latencies, 95),
+                     'p99_seconds': _percentile(latencies, 99)}
+
+
+# how many urls the Parser holding a whole list is run on by default, it being much
+# slower than the BlockListParser engines
+PARSER_URLS = 200
+
+
+def _build_automaton(lines):
+    return BlockListParser(regexes=lines)
+
+
+def _build_hash(lines):
+    return BlockListParser(regexes=lines, support_hash=True)
+
+
+def _build_parser(lines):
+    return Parser(lines)
+
+
+def _fresh_build(build_engine, regex_file, measure_memory):
+    """Returns the time build_engine takes to build an engine of regex_file and the peak
+    memory traced while building another one (None unless measure_memory), run in a
+    process of its own whose rule tables are emptied before each build"""
+    with open(regex_file) as f:
+        lines = f.readlines()
+    clear_rule_tables()
+    start = time.time()
+    build_engine(lines)
+    build_seconds = time.time() - start
+    peak_bytes = None
+    if measure_memory:
+        # tracing slows the build down, so it is timed separately
+        clear_rule_tables()
+        tracemalloc.start()
+        build_engine(lines)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return build_seconds, peak_bytes
+
+
+def _build(build_engine, regex_file, lines, measure_memory):
+    """Returns the engine built by build_engine, and the build time and peak memory of
+    an engine built in a separate process, where no rule of the list is interned in
+    the RuleTable yet and no regex is compiled, as for the first list loaded"""
+    start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    with multiprocessing.get_context(start_method).Pool(1) as pool:
+        build_seconds, peak_bytes = pool.apply(_fresh_build, (build_engine, regex_file, measure_memory))
+    return build_engine(lines), build_seconds, peak_bytes
+
+
+def run_suite(regex_file, urls, options_list=None, measure_memory=True, parser_urls=PARSER_URLS):
+    """Benchmark the engines on regex_file over urls.
+
+    The engines are BlockListParser with its shortcut automaton ('automaton') and
+    with its rolling-hash scan ('hash'), and a single RegexParser.Parser holding
+    every rule ('parser'). The Parser checks every rule whose options fit against
+    each url, so it is only run on the first parser_urls urls (every url if None).
+    It may disagree with the other engines on urls matched by rules with upper case
+    letters, which BlockListParser only looks for by their lower case shortcuts.
+
+    Returns a dict with, for each engine, its 'build_seconds', 'peak_bytes' and the
+    latency percentiles of each of its calls, and the number of 'mismatches' of each
+    call's verdicts with automaton's should_block.
+    """
+    if options_list is None:
+        options_list = generate_options(urls)
+    with open(regex_file) as f:
+        lines = f.readlines()
+    engines = [
+        ('automaton', _build_automaton, len(urls), [
+            ('should_block', lambda engine: engine.should_block),
+            ('should_block_with_items', lambda engine: lambda url, options:
+                engine.should_block_with_items(url, options)[0])]),
+        ('hash', _build_hash, len(urls), [
+            ('should_block', lambda engine: engine.should_block)]),
+    ]
+    if parser_urls is None or parser_urls > 0:
+        engines.append(('parser', _build_parser, len(urls) if parser_urls is None else parser_urls, [
+            ('check', lambda engine: lambda url, options: engine.check(url, options) == -1),
+            ('check_with_items', lambda engine: lambda url, options:
+                engine.check_with_items(url, options)[0] == -1)]))
+    report = {'urls': len(urls), 'mismatches': {}}
+    reference = None
+    for name, build_engine, num_urls, calls in engines:
+        engine, build_seconds, peak_bytes = _build(build_engine, regex_file, lines, measure_memory)
+        report[name] = {'build_seconds': build_seconds, 'peak_bytes': peak_bytes}
+        for call_name, get_call in calls:
+            call = get_call(engine)
+            # warm up the lazily compiled regexes before timing
+            _time_each(call, urls[:num_urls], options_list)
+            verdicts, latencies = _time_each(call, urls[:num_urls], options_list)
+            report[name][call_name] = latencies
+            if reference is None:
+                reference = verdicts
+            else:
+                report['mismatches']['%s.%s' % (name, call_name)] = sum(
+                    a != b for a, b in zip(reference, verdicts))
+        if name == 'automaton':
+            start = time.time()
+            verdicts = engine.should_block_many(urls, options_list)
+            report[name]['should_block_many'] = {'calls': 1, 'seconds': time.time() - start}
+            report['mismatches']['automaton.should_block_many'] = sum(
+                a != b for a, b in zip(reference, verdicts))
+    return report
+
+
+def print_suite_report(regex_file, report):
+    print("%s (%d urls)" % (regex_file, report['urls']))
+    for name in ('automaton', 'hash', 'parser'):
+        if name not in report:
+            continue
+        engine_report = report[name]
+        memory = ('%.1f MB' % (engine_report['peak_bytes'] / 1e6)
+                  if engine_report['peak_bytes'] is not None else 'n/a')
+        print("  %-9s build %.2fs, peak memory %s" % (name, engine_report['build_seconds'], memory))
+        for call_name, latencies in engine_report.items():
+            if not isinstance(latencies, dict):
+                continue
+            if 'p50_seconds' in latencies:
+                print("    %-24s %5d calls  p50 %7.1fus  p95 %7.1fus  p99 %7.1fus  mean %7.1fus  %8.0f urls/s" % (
+                    call_name, latencies['calls'], latencies['p50_seconds'] * 1e6, latencies['p95_seconds'] * 1e6,
+                    latencies['p99_seconds'] * 1e6, latencies['mean_seconds'] * 1e6,
+                    1 / latencies['mean_seconds'] if latencies['mean_seconds'] else float('inf')))
+            else:
+                print("    %-24s %.2fs for the batch" % (call_name, latencies['seconds']))
+    for call_name, mismatches in sorted(report['mismatches'].items()):
+        print("  verdict mismatches %-33s %d" % (call_name, mismatches))
+
+
+def check_regex_simplification(regex_files, urls):
+    """Check that SingleRuleParser.simplify_rule keeps the verdict of every rule.
+
+    Each simplified rule's regex is searched, with and without simplification, in
+    urls and in urls made from the rule text itself (so that most rules match some
+    of them). Returns the number of rules, of simplified rules, and the
+    (rule, url) pairs on which the two regexes disagree.
+    """
+    num_rules = 0
+    simplified = 0
+    mismatches = []
+    for regex_file in regex_files:
+        with open(regex_file) as f:
+            for line in f:
+                rule = SingleRuleParser(line)
+                if rule.is_comment or rule.is_html_rule:
+                    continue
+                num_rules += 1
+                original = re.compile(SingleRuleParser.rule_to_regex(rule.rule_text, simplify=False))
+                if original.pattern == rule.regex:
+                    continue
+                simplified += 1
+                regex_re = re.compile(rule.regex)
+                example = rule.rule_text.lstrip('|').rstrip('|').replace('*', 'x').replace('^', '/')
+                for url in urls + ['http://' + example, 'http://a.com/' + example + '?q=1', example]:
+                    if bool(original.search(url)) != bool(regex_re.search(url)):
+                        mismatches.append((line.strip(), url))
+    return {'rules': num_rules, 'simplified': simplified, 'mismatches': mismatches}
+
+
+if __name__ == '__main__':
+    regex_files = sys.argv[1:] or ['easylist.txt', 'easyprivacy.txt']
+    urls, options_list = generate_corpus(regex_files, 5000)
+    print("%d urls, mean length %.0f" % (len(urls), sum(len(url) for url in urls) / float(len(urls))))
+    for regex_file in regex_files:
+        print_suite_report(regex_file, run_suite(regex_file, urls, options_list))
+    report = check_regex_simplification(regex_files, urls[:200])
+    print("regex simplification: %d of %d rules simplified, %d mismatches" % (
+        report['simplified'], report['rules'], len(report['mismatches'])))
@@ -3,8 +3,6 @@ from collections import Counter, defaultdict
 import collections
 import csv
 import itertools
-import matplotlib.pyplot as plt
-import numpy as np
 import os
 import re
 import psycopg2
@@ -96,17 +94,11 @@ class URI(object):
     @property
     def is_tracker(self):
         if self._is_tracker == None:
-            is_el_tracker = utils.is_tracker(self._url, 
-                                             is_js=self._is_js,
-                                             is_img=self._is_img, 
-                                             first_party='http://'+self._first_party._domain, 
-                                             blocklist='easylist')
-            is_ep_tracker = utils.is_tracker(self._url, 
-                                             is_js=self._is_js,
-                                             is_img=self._is_img, 
-                                             first_party='http://'+self._first_party._domain, 
-                                             blocklist='easyprivacy')
-            self._is_tracker = is_el_tracker or is_ep_tracker
+            verdicts = utils.check_tracker(self._url,
+                                           is_js=self._is_js,
+                                           is_img=self._is_img,
+                                           first_party='http://'+self._first_party._domain)
+            self._is_tracker = len(utils.get_blocking_lists(verdicts)) > 0
         return self._is_tracker
     
     @is_tracker.setter
@@ -884,6 +876,25 @@ class Census:
         cur.close()
         return domains
     
+    def get_response_url_sample(self, sample_size=10000):
+        """Return a list of sample_size urls from http_responses_view, e.g. to pass as
+        the url_corpus of a BlockListParser."""
+        query = "SELECT url FROM http_responses_view LIMIT %s"
+
+        cur = self.connection.cursor()
+        cur.itersize = 100000
+        try:
+            cur.execute(query, (sample_size,))
+        except:
+            self._reconnect()
+            cur = self.connection.cursor()
+            cur.itersize = 100000
+            cur.execute(query, (sample_size,))
+
+        urls = [url for url, in cur]
+        cur.close()
+        return urls
+
     def check_top_url(self, top_url):
         """Return True if a top_url is present in the census."""
         top_url = 'http://' + top_url
@@ -1031,19 +1042,6 @@ class Census:
 
             is_js = utils.is_js(url, content_type)
             is_img = utils.is_img(url, content_type)
-            if not lazy:
-                is_el_tracker = utils.is_tracker(url, 
-                                                 is_js=is_js,
-                                                 is_img=is_img, 
-                                                 first_party=top_url, 
-                                                 blocklist='easylist')
-                is_ep_tracker = utils.is_tracker(url, 
-                                                 is_js=is_js,
-                                                 is_img=is_img, 
-                                                 first_party=top_url, 
-                                                 blocklist='easyprivacy')
-                is_tracker = is_el_tracker or is_ep_tracker
-                url_data['is_tracker'] = is_tracker
 
             organization = utils.get_org(url)
             
@@ -1053,8 +1051,48 @@ class Census:
             
             response_data[url] = url_data
         cur.close()
+
+        if not lazy:
+            # Classify all of the site's resources against both blocklists in one batch
+            urls = list(response_data)
+            is_js = [response_data[url]['is_js'] for url in urls]
+            is_img = [response_data[url]['is_img'] for url in urls]
+            all_verdicts = utils.check_tracker_many(urls,
+                                                    is_js=is_js,
+                                                    is_img=is_img,
+                                                    first_party=top_url)
+            for url, verdicts in zip(urls, all_verdicts):
+                tracker_lists = utils.get_blocking_lists(verdicts)
+                response_data[url]['is_tracker'] = len(tracker_lists) > 0
+                response_data[url]['tracker_lists'] = tracker_lists
         return dict(response_data)
 
+    def _classify_third_party_responses(self, sites, pool):
+        """Yield (site, url_data) for each third-party resource of each of sites, url_data
+        being as in get_all_third_party_responses_by_site, classified by a ClassificationPool.
+
+        Sites are queried as the pool takes in more resources, which it only reads a few
+        chunks ahead of the verdicts given back, so the queries overlap with the
+        classification and only the resources waiting for their verdicts are kept."""
+        pending = collections.deque()
+
+        def get_items():
+            for site in sites:
+                tp_data = self.get_all_third_party_responses_by_site(site, lazy=True)
+                if tp_data is None:
+                    continue
+                for url, url_data in tp_data.items():
+                    pending.append((site, url_data))
+                    yield url, url_data['is_js'], url_data['is_img'], 'http://' + site
+
+        # verdicts come back in the order of the items
+        for verdicts in pool.imap(get_items()):
+            site, url_data = pending.popleft()
+            tracker_lists = utils.get_blocking_lists(verdicts)
+            url_data['is_tracker'] = len(tracker_lists) > 0
+            url_data['tracker_lists'] = tracker_lists
+            yield site, url_data
+
     def get_third_party_organizations_by_site(self, top_url):
         """Get a list of third-party organizations found on a particular site (top_url)."""
         results = self.get_all_third_party_responses_by_site(top_url)
@@ -1067,6 +1105,9 @@ class Census:
         
         Limit graphed output to top_n most frequent third parties
         """
+        # imported here, so that batch jobs do not pay for the plotting libraries
+        import matplotlib.pyplot as plt
+        import numpy as np
         sites = self._filter_site_list(sites)
         orgs_count = Counter()
         for site in sites:
@@ -1077,8 +1118,11 @@ class Census:
         plt.xticks(np.arange(top_n), [x[0] for x in orgs_count.most_common(top_n)])
         plt.tick_params(axis='both', which='major', labelsize=22)
             
-    def get_third_party_resources_for_multiple_sites(self, sites, filepath=''):
+    def get_third_party_resources_for_multiple_sites(self, sites, filepath='', processes=None):
         """Get third party data loaded on multiple sites and write results to disk.
+
+        The sites are queried one after another while their resources are classified
+        by a pool of processes worker processes (one per core by default).
         """
         sites = self._filter_site_list(sites)
         tracker_js_by_top = defaultdict(set)
@@ -1088,22 +1132,21 @@ class Census:
 
         tracker_other_by_top = defaultdict(set)
         non_tracker_other_by_top = defaultdict(set)
-        for site in sites:
-            tp_data = self.get_all_third_party_responses_by_site(site)
-            for url in tp_data:
-                url_ps = tp_data[url]['url_domain']
-                is_tracker = tp_data[url]['is_tracker']
+        with utils.get_classification_pool(processes) as pool:
+            for site, url_data in self._classify_third_party_responses(sites, pool):
+                url_ps = url_data['url_domain']
+                is_tracker = url_data['is_tracker']
                 if is_tracker:
-                    if tp_data[url]['is_js']:
+                    if url_data['is_js']:
                         tracker_js_by_top[site].add(url_ps)
-                    elif tp_data[url]['is_img']:
+                    elif url_data['is_img']:
                         tracker_img_by_top[site].add(url_ps)
                     else:
                         tracker_other_by_top[site].add(url_ps)
                 else:
-                    if tp_data[url]['is_js']:
+                    if url_data['is_js']:
                         non_tracker_js_by_top[site].add(url_ps)
-                    elif tp_data[url]['is_img']:
+                    elif url_data['is_img']:
                         non_tracker_img_by_top[site].add(url_ps)           
                     else:
                         non_tracker_other_by_top[site].add(url_ps)
@@ -1,66 +1,274 @@
 """Utils for analyzing Princeton Web Census data."""
-from BlockListParser import BlockListParser
-from ipaddress import ip_address
-from publicsuffix import PublicSuffixList, fetch
-from urllib.parse import urlparse
+import time
+_import_start = time.perf_counter()
+
+from BlockListParser import BlockListParser, CombinedBlockListParser
+from ClassificationPool import ClassificationPool
+from LRUCache import LRUCache
+from OrganizationIndex import OrganizationIndex
+from PublicSuffixTrie import HOSTNAME_CACHE_SIZE, PublicSuffixTrie, is_ip_address
+from RequestContext import RequestContext
+from urllib.parse import urlparse, urlsplit
 
 import codecs
 import json
+import os
 
-PSL_CACHE_LOC = 'public_suffix_list.dat'
-
-# Execute on module load
-psl_cache = codecs.open(PSL_CACHE_LOC, encoding='utf8')
-psl = PublicSuffixList(psl_cache)
-el_parser = BlockListParser('easylist.txt')
-ep_parser = BlockListParser('easyprivacy.txt')
+# the data files are next to the censuslib package, whatever the working directory
+RESOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PSL_CACHE_LOC = os.path.join(RESOURCE_DIR, 'public_suffix_list.dat')
+BLOCKLIST_CACHE_DIR = os.path.join(RESOURCE_DIR, '.blocklist_cache')
+BLOCKLISTS = [('easylist', os.path.join(RESOURCE_DIR, 'easylist.txt')),
+              ('easyprivacy', os.path.join(RESOURCE_DIR, 'easyprivacy.txt'))]
+ORG_DOMAINS_LOC = os.path.join(RESOURCE_DIR, 'org_domains.json')
+ALEXA_CATS_LOC = os.path.join(RESOURCE_DIR, 'alexa_cats.json')
+VERDICT_CACHE_SIZE = 100000
+CLASSIFICATION_CHUNK_SIZE = 500
 
-with open('org_domains.json', 'r') as f:
-    org_domains = json.load(f)
-
-with open('alexa_cats.json', 'r') as f:
-    alexa_cats = json.load(f)
+# verdicts of is_tracker and check_tracker, only kept once enable_verdict_cache is called
+verdict_cache = None
+# cached in place of a verdict which depends on the first party domain
+_DOMAIN_SENSITIVE = 'domain-sensitive'
     
 class CensusUtilsException(Exception):
     pass
 
+#########################################################
+# Resources, loaded on first use
+#########################################################
+
+def _load_psl():
+    with codecs.open(PSL_CACHE_LOC, encoding='utf8') as psl_cache:
+        return PublicSuffixTrie(psl_cache, HOSTNAME_CACHE_SIZE)
+
+def _load_blocklist_parser():
+    return CombinedBlockListParser(BLOCKLISTS, cache_dir=BLOCKLIST_CACHE_DIR)
+
+def _load_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# name -> function loading the resource, also readable as a module attribute (utils.psl, ...)
+_RESOURCE_LOADERS = {
+    'psl': _load_psl,
+    'blocklist_parser': _load_blocklist_parser,
+    'org_domains': lambda: _load_json(ORG_DOMAINS_LOC),
+    'org_index': lambda: OrganizationIndex(_get_resource('org_domains')),
+    'alexa_cats': lambda: _load_json(ALEXA_CATS_LOC),
+}
+_resources = {}
+# name -> seconds spent loading it, and importing this module under 'import'
+_startup_times = {}
+
+def _get_resource(name):
+    try:
+        return _resources[name]
+    except KeyError:
+        start = time.perf_counter()
+        resource = _resources[name] = _RESOURCE_LOADERS[name]()
+        _startup_times[name] = time.perf_counter() - start
+        return resource
+
+def __getattr__(name):
+    if name in _RESOURCE_LOADERS:
+        return _get_resource(name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def load_resources(names=None):
+    """Load the given resources now (all of psl, blocklist_parser, org_domains,
+    org_index and alexa_cats by default) rather than on first use, e.g. before
+    forking worker processes."""
+    for name in names or _RESOURCE_LOADERS:
+        _get_resource(name)
+
+def get_startup_times():
+    """Return the seconds spent importing this module and loading each resource loaded
+    so far (including the resources it needed, e.g. org_domains for org_index)."""
+    return dict(_startup_times)
+
 def get_domain(url):
     """Strip the URL down to just a hostname+publicsuffix.
 
     If the provided url contains an IP address, the IP address is returned.
     """
 
-    hostname = urlparse(url).hostname
-    try:
-        ip_address(hostname)
+    return _get_hostname_domain(urlsplit(url).hostname)
+
+def get_domains(urls):
+    """Return get_domain(url) for each of the given urls, resolving each distinct hostname once."""
+    domains = {}
+    result = []
+    for url in urls:
+        hostname = urlsplit(url).hostname
+        domain = domains.get(hostname)
+        if domain is None:
+            domain = domains[hostname] = _get_hostname_domain(hostname)
+        result.append(domain)
+    return result
+
+def get_domain_cache_stats():
+    """Return the size, hits, misses and evictions of the hostname to domain cache."""
+    return _get_resource('psl').stats()
+
+def _get_hostname_domain(hostname):
+    # psl raises AttributeError for urls without a hostname
+    if hostname is not None and is_ip_address(hostname):
         return hostname
-    except ValueError:
-        return psl.get_public_suffix(hostname)
+    return _get_resource('psl').get_public_suffix(hostname)
     
+def _check_blocklist(blocklist):
+    if blocklist not in _get_resource('blocklist_parser').list_names:
+        raise CensusUtilsException("You must provide a supported blocklist: easylist, easyprivacy")
+
+def make_request_context(url, is_js=False, is_img=False, fp_domain=None):
+    """Return the RequestContext a url is checked against the blocklists with, in the
+    context of the first party domain fp_domain (if provided).
+
+    It may be passed to the blocklist parsers in place of an options dict, so the
+    url's options and their masks are only computed once.
+    """
+    hostname = urlsplit(url).hostname
+    third_party = None
+    # only given for third-party urls, so $~third-party rules never apply
+    if fp_domain and _get_hostname_domain(hostname) != fp_domain:
+        third_party = True
+    return RequestContext(fp_domain or None, third_party,
+                          {'script': is_js, 'image': is_img})
+
+def _get_request_contexts(urls, is_js, is_img, first_party):
+    fp_domain = get_domain(first_party) if first_party else None
+    if is_js is None:
+        is_js = [False] * len(urls)
+    if is_img is None:
+        is_img = [False] * len(urls)
+    return [make_request_context(url, url_is_js, url_is_img, fp_domain)
+            for url, url_is_js, url_is_img in zip(urls, is_js, is_img)]
+
+def enable_verdict_cache(maxsize=VERDICT_CACHE_SIZE, max_bytes=None):
+    """Memoize the verdicts of is_tracker and check_tracker in an LRU cache holding at
+    most maxsize entries and/or about max_bytes bytes, and return the cache.
+
+    A verdict is cached for the url, its type and its third-party flag, and only
+    for the first party domain too when $domain rules apply to the url, so a url
+    seen on many first parties is usually classified once.
+    """
+    global verdict_cache
+    verdict_cache = LRUCache(maxsize, max_bytes)
+    return verdict_cache
+
+def disable_verdict_cache():
+    global verdict_cache
+    verdict_cache = None
+
+def get_verdict_cache_stats():
+    """Return the size, hits, misses and evictions of the verdict cache, or None if it is disabled."""
+    if verdict_cache is None:
+        return None
+    return verdict_cache.stats()
+
+def _check_blocklists(url, context, list_names=None):
+    """Return blocklist_parser.check(url, context, list_names), through the verdict
+    cache if it is enabled."""
+    blocklist_parser = _get_resource('blocklist_parser')
+    if verdict_cache is None:
+        return blocklist_parser.check(url, context, list_names)
+    if list_names is None:
+        list_names = blocklist_parser.list_names
+    fp_domain = context.domain
+    key = (url,) + context.signature
+    states = {}
+    missing = []
+    for list_name in list_names:
+        # one hit or miss per lookup, even when it goes through the domain-sensitive marker
+        state = verdict_cache.get(key + (list_name,), count=False)
+        if state == _DOMAIN_SENSITIVE:
+            state = verdict_cache.get(key + (list_name, fp_domain), count=False)
+        verdict_cache.count_lookup(state is not None)
+        if state is None:
+            missing.append(list_name)
+        else:
+            states[list_name] = state
+    if missing:
+        checked = blocklist_parser.check_with_domain_sensitivity(url, context, missing)
+        for list_name, (state, domain_sensitive) in checked.items():
+            if domain_sensitive:
+                verdict_cache.put(key + (list_name,), _DOMAIN_SENSITIVE)
+                verdict_cache.put(key + (list_name, fp_domain), state)
+            else:
+                verdict_cache.put(key + (list_name,), state)
+            states[list_name] = state
+    return dict((list_name, states[list_name]) for list_name in list_names)
+
 def is_tracker(url, is_js=False, is_img=False, 
                first_party=None, blocklist='easylist'):
     """Return a bool determining if a given url is a tracker in the given
     first party context (if first_party provided)."""
     
-    if blocklist == 'easylist':
-        parser = el_parser
-    elif blocklist == 'easyprivacy':
-        parser = ep_parser
-    else:
-        raise CensusUtilsException("You must provide a supported blocklist: easylist, easyprivacy")
-        
-    options = dict()
-    if first_party:
-        fp_domain = get_domain(first_party)
-        url_domain = get_domain(url)
+    _check_blocklist(blocklist)
+    fp_domain = get_domain(first_party) if first_party else None
+    context = make_request_context(url, is_js, is_img, fp_domain)
+
+    return _check_blocklists(url, context, [blocklist])[blocklist] == -1
+
+def is_tracker_many(urls, is_js=None, is_img=None,
+                    first_party=None, blocklist='easylist'):
+    """Return a list of bools determining if each of the given urls is a tracker
+    in the given first party context (if first_party provided).
+
+    is_js and is_img are lists aligned with urls. The whole batch is classified
+    at once, which is much faster than calling is_tracker for each url.
+    """
+    _check_blocklist(blocklist)
+    contexts = _get_request_contexts(urls, is_js, is_img, first_party)
+
+    return [verdicts[blocklist] for verdicts in
+            _get_resource('blocklist_parser').should_block_many(urls, contexts, [blocklist])]
+
+def check_tracker(url, is_js=False, is_img=False, first_party=None):
+    """Check a url against every blocklist at once, in the given first party
+    context (if first_party provided).
+
+    Return a dict mapping each blocklist name to -1 if that list blocks the url,
+    1 if it whitelists it, and 0 otherwise.
+    """
+    fp_domain = get_domain(first_party) if first_party else None
+    context = make_request_context(url, is_js, is_img, fp_domain)
+
+    return _check_blocklists(url, context)
 
-        if url_domain != fp_domain:
-            options['third-party'] = True
-        options['domain'] = fp_domain
-    options['image'] = is_img
-    options['script'] = is_js
+def check_tracker_many(urls, is_js=None, is_img=None, first_party=None):
+    """Return check_tracker's dict for each of the given urls, classifying the
+    whole batch at once. is_js and is_img are lists aligned with urls."""
+    contexts = _get_request_contexts(urls, is_js, is_img, first_party)
 
-    return parser.should_block(url, options)
+    return _get_resource('blocklist_parser').check_many(urls, contexts)
+
+def _check_tracker_chunk(chunk):
+    """Return check_tracker's dict for each (url, is_js, is_img, first_party) of chunk."""
+    fp_domains = {}
+    urls = []
+    contexts = []
+    for url, url_is_js, url_is_img, first_party in chunk:
+        if first_party not in fp_domains:
+            fp_domains[first_party] = get_domain(first_party) if first_party else None
+        urls.append(url)
+        contexts.append(make_request_context(url, url_is_js, url_is_img, fp_domains[first_party]))
+    return _get_resource('blocklist_parser').check_many(urls, contexts)
+
+def get_classification_pool(processes=None, chunk_size=CLASSIFICATION_CHUNK_SIZE):
+    """Return a ClassificationPool of worker processes (one per core by default)
+    sharing this module's blocklists, to be used as a context manager.
+
+    Its imap and map take (url, is_js, is_img, first_party) tuples, classified in
+    chunks of chunk_size, and give check_tracker's dict for each, in order.
+    """
+    # loaded before the workers are forked, so that they share them
+    load_resources(['psl', 'blocklist_parser'])
+    return ClassificationPool(_check_tracker_chunk, processes, chunk_size)
+
+def get_blocking_lists(verdicts):
+    """Return the names of the blocklists blocking a url, given its check_tracker dict."""
+    return [blocklist for blocklist, state in verdicts.items() if state == -1]
 
 def get_trackers(url_list, first_party, blocklist_parser=None, blocklist="easylist.txt"):
     """Identify domains that are identified as trackers from list of URLs.
@@ -81,53 +289,48 @@ def get_trackers(url_list, first_party, blocklist_parser=None, blocklist="easyli
 def get_alexa_categories():
     """Return a dictionary mapping categories to an ordered list of the top 500 sites in that category."""
 
-    return alexa_cats
+    return _get_resource('alexa_cats')
+
+def _get_org_domain(url):
+    if 'http:' in url or 'https:' in url:
+        return get_domain(url)
+    return url
 
 def get_org(url):
     """If possible, find the name of the organization owning this particular URL/domain.
+    A domain not listed itself is looked up by its parent domains.
     
     If no organization is found, return none.
     """
-    if 'http:' in url or 'https:' in url:
-        url_domain = get_domain(url)
-        organization = None
-    else:
-        url_domain = url
-        organization = None
-        
-    for org in org_domains:
-        try:
-            if url_domain in org[u'domains']:
-                organization = org[u'organization']
-        except KeyError:
-            continue
-     
-    return organization
+    orgs = _get_resource('org_index').lookup(_get_org_domain(url))
+    if orgs is None:
+        return None
+    return orgs[-1][u'organization']
+
+def get_orgs(urls):
+    """Return get_org(url) for each of the given urls/domains, looking up each distinct one once."""
+    orgs = {}
+    result = []
+    for url in urls:
+        if url not in orgs:
+            orgs[url] = get_org(url)
+        result.append(orgs[url])
+    return result
         
 def get_full_organization_details(url):    
     """If possible, find the organization owning this particular URL/domain and return its full details.
+    A domain not listed itself is looked up by its parent domains.
     
     If no organization is found, return None.
     """
-    if 'http:' in url or 'https:' in url:
-        url_domain = get_domain(url)
-        organization = None
-    else:
-        url_domain = url
-        organization = None
-        
-    for org in org_domains:
-        try:
-            if url_domain in org[u'domains']:
-                return org
-        except KeyError:
-            continue
-     
-    return None
+    orgs = _get_resource('org_index').lookup(_get_org_domain(url))
+    if orgs is None:
+        return None
+    return orgs[0]
 
 def get_organizations_list():
     """Return the complete list of known organizations."""
-    return org_domains[1:]
+    return _get_resource('org_domains')[1:]
     
 
 def should_ignore(url):
@@ -236,3 +439,5 @@ def is_js(url, content_type):
     if urlparse(url).path.split('.')[-1].lower() == 'js':
         return True
     return False
+
+_startup_times['import'] = time.perf_counter() - _import_start